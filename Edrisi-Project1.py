@@ -1,30 +1,369 @@
 from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from decimal import Decimal, DecimalException, ROUND_HALF_UP
+import csv
+import gc
+import heapq
+import itertools
+import json
+import mmap
+import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import unicodedata
 import uuid
+import weakref
+
+try:
+    import numpy as np
+except ImportError:  # optional: DiscountStrategy.apply_many falls back to plain Python
+    np = None
+
+#  Stock locks
+#
+# Stock changes are check-then-act, so they run under a lock. Locks are
+# striped by product id: products in different stripes never contend.
+
+class StripedLocks:
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+    # returns once every stripe has been free at least once since the call,
+    # i.e. everything that was running under any of the locks has finished
+    def barrier(self):
+        for lock in self._locks:
+            with lock:
+                pass
+
+    # Holds the locks for all `keys` at once. Stripes are always taken in
+    # index order, so two callers holding overlapping sets cannot deadlock.
+    def holding(self, keys):
+        stripes = len(self._locks)
+        return _HeldLocks([self._locks[i] for i in sorted({hash(key) % stripes for key in keys})])
+
+
+class _HeldLocks:
+    __slots__ = ("_locks",)
+
+    def __init__(self, locks):
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+
+    def __exit__(self, *exc):
+        for lock in reversed(self._locks):
+            lock.release()
+
+
+STOCK_LOCKS = StripedLocks()
+
+
+#  Money
+#
+# All amounts (prices, line totals, cart totals, discounts, orders) are
+# integers counting cents. Decimal is only used to parse input.
+
+MAX_CENTS = 2 ** 63 - 1  # amounts are stored in int64 columns
+
+
+def to_cents(value):
+    if isinstance(value, int):
+        cents = value * 100
+    else:
+        try:
+            amount = Decimal(str(value).strip())
+            if not amount.is_finite() or abs(amount) * 100 > MAX_CENTS:
+                raise ValueError(f"Invalid amount: {value!r}")
+            cents = int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        except DecimalException:
+            raise ValueError(f"Invalid amount: {value!r}")
+    if abs(cents) > MAX_CENTS:
+        raise ValueError(f"Invalid amount: {value!r}")
+    return cents
+
+
+def format_money(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+# `basis_points` is hundredths of a percent; rounds half up
+def percent_of(cents, basis_points):
+    return (cents * basis_points + 5000) // 10000
+
+
+# a `percent` attribute that keeps `_basis_points` in step with it
+def _percent_property():
+    def get(self):
+        return self._percent
+
+    def set(self, value):
+        self._basis_points = to_cents(value)
+        self._percent = value
+
+    return property(get, set)
+
 
 #  Product
 
+def normalize(text, strip_accents=False):
+    text = text.casefold()
+    if strip_accents:
+        text = "".join(
+            c for c in unicodedata.normalize("NFKD", text)
+            if not unicodedata.combining(c)
+        )
+    return text
+
+
+# A product's listeners: `fields` get every change, `stock` only stock
+# changes. Most products have none, so this is created on first subscribe.
+class _Listeners:
+    __slots__ = ("fields", "stock")
+
+    def __init__(self):
+        self.fields = {}
+        self.stock = {}
+
+
 class Product:
+    __slots__ = (
+        "_listeners", "_search_keys", "id", "_name", "_category", "_price",
+        "_stock", "version", "__weakref__",
+    )
+
+    # see OptimisticProduct
+    optimistic = False
+
     def __init__(self, product_id, name, category, price, stock):
+        self._listeners = None
+        self._search_keys = None
         self.id = product_id
-        self.name = name
-        self.category = category
-        self.price = price
-        self.stock = stock
+        self._name = name
+        self._category = sys.intern(category)
+        self._price = price
+        self._stock = stock
+        self.version = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        old = self._name
+        self._name = value
+        self._search_keys = None
+        self._notify("name", old)
+
+    @property
+    def category(self):
+        return self._category
+
+    @category.setter
+    def category(self, value):
+        old = self._category
+        self._category = sys.intern(value)
+        self._search_keys = None
+        self._notify("category", old)
+
+    @property
+    def price(self):
+        return self._price
+
+    @price.setter
+    def price(self, value):
+        old = self._price
+        self._price = value
+        self._notify("price", old)
+
+    # (strip_accents, name_key, category_key), cached until name/category change
+    def search_keys(self, strip_accents=False):
+        keys = self._search_keys
+        if keys is None or keys[0] != strip_accents:
+            keys = self._search_keys = (
+                strip_accents,
+                normalize(self._name, strip_accents),
+                sys.intern(normalize(self._category, strip_accents)),
+            )
+        return keys
+
+    # listeners are called as listener(product, field, old_value); they are
+    # kept as dict keys so unsubscribing stays O(1) for popular products
+    def subscribe(self, listener):
+        if self._listeners is None:
+            self._listeners = _Listeners()
+        self._listeners.fields[listener] = None
+
+    def unsubscribe(self, listener):
+        if self._listeners is not None:
+            self._listeners.fields.pop(listener, None)
+
+    # stock changes are far more frequent than the others, so they only go
+    # to listeners that ask for them, not to every cart holding the product
+    def subscribe_stock(self, listener):
+        if self._listeners is None:
+            self._listeners = _Listeners()
+        self._listeners.stock[listener] = None
+
+    def unsubscribe_stock(self, listener):
+        if self._listeners is not None:
+            self._listeners.stock.pop(listener, None)
+
+    def _notify(self, field, old):
+        listeners = self._listeners
+        if listeners is not None and listeners.fields:
+            for listener in tuple(listeners.fields):
+                listener(self, field, old)
+
+    # every stock write bumps the version, which is what compare_and_set checks,
+    # and calls the stock listeners while the stock lock is still held
+    @property
+    def stock(self):
+        return self._stock
+
+    @stock.setter
+    def stock(self, value):
+        old = self._stock
+        self._stock = value
+        self.version += 1
+        listeners = self._listeners
+        if listeners is not None and listeners.stock:
+            for listener in tuple(listeners.stock):
+                listener(self, "stock", old)
 
     def reduce_stock(self, amount):
-        if amount > self.stock:
-            raise ValueError("Not enough stock")
-        self.stock -= amount
+        if self.optimistic:
+            return self._reduce_stock_optimistic(amount)
+        with STOCK_LOCKS.lock_for(self.id):
+            if amount > self.stock:
+                raise ValueError("Not enough stock")
+            self.stock -= amount
+
+    def add_stock(self, amount):
+        with STOCK_LOCKS.lock_for(self.id):
+            self.stock += amount
+
+    # Python has no CAS instruction, so the swap itself runs under the stock
+    # lock; the read and the stock check happen outside of it.
+    def compare_and_set_stock(self, expected_version, value):
+        with STOCK_LOCKS.lock_for(self.id):
+            if self.version != expected_version:
+                return False
+            self.stock = value
+            return True
+
+    def _reduce_stock_optimistic(self, amount, max_attempts=64):
+        delay = 1e-6
+        for _ in range(max_attempts):
+            version = self.version  # read before stock, see compare_and_set_stock
+            stock = self._stock
+            if amount > stock:
+                raise ValueError("Not enough stock")
+            if self.compare_and_set_stock(version, stock - amount):
+                return
+            time.sleep(delay * random.random())
+            delay = min(delay * 2, 1e-3)
+        # heavy contention: stop spinning and take the lock
+        with STOCK_LOCKS.lock_for(self.id):
+            if amount > self.stock:
+                raise ValueError("Not enough stock")
+            self.stock -= amount
+
+
+# takes stock with compare-and-set plus retry instead of holding the stock
+# lock around check and decrement
+class OptimisticProduct(Product):
+    __slots__ = ()
+    optimistic = True
 
 
 #  Inventory
 
+_TOKEN_RE = re.compile(r"\w+")
+
+
+# `key` is text that has already been through normalize()
+def tokenize(key):
+    return _TOKEN_RE.findall(key)
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+# while a checkout writes the stock its record already carries, `log` is the
+# log that record went to; stock listeners writing to that same log skip
+# these writes instead of logging them a second time
+class _RecordedStock(threading.local):
+    log = None
+
+
+_RECORDED_STOCK = _RecordedStock()
+
+
 class Inventory:
-    def __init__(self):
+    def __init__(self, strip_accents=False):
+        self.strip_accents = strip_accents
         self.products = {}
+        self._order = {}     # product id -> insertion sequence
+        self._tokens = {}    # token -> set of product ids
+        self._trigrams = {}  # trigram -> set of tokens containing it
+        self._categories = {}  # category key -> {product id: None}, in insertion order
+        # sorted [(price, insertion sequence, product id)]; key None holds the
+        # whole catalog, every other key one category
+        self._prices = {None: []}
+        self._unsorted_prices = None  # price keys appended to during add_products
+        self.log = None      # OrderLog that product and stock changes go to
 
     def add_product(self, product):
+        old = self.products.get(product.id)
+        if old is not None:
+            old.unsubscribe(self._on_product_change)
+            old.unsubscribe_stock(self._on_stock_change)
+            self._unindex_product(old)
+        else:
+            self._order[product.id] = len(self._order)
         self.products[product.id] = product
+        self._index_product(product)
+        product.subscribe(self._on_product_change)
+        if self.log is not None:
+            product.subscribe_stock(self._on_stock_change)
+            self.log.append(product_record(product))
+
+    # like add_product for every product, but the price lists are sorted
+    # once at the end instead of insorting entry by entry
+    def add_products(self, products):
+        self._unsorted_prices = set()
+        try:
+            for product in products:
+                self.add_product(product)
+        finally:
+            self._sort_prices()
+            self._unsorted_prices = None
+
+    # from now on every added product and every product or stock change is
+    # appended to `log`; with write_products=True the current catalog is
+    # written first (use that when starting a fresh log)
+    def attach_log(self, log, write_products=False):
+        for product in self.products.values():
+            if write_products:
+                log.append(product_record(product))
+            product.subscribe_stock(self._on_stock_change)
+        self.log = log
 
     def list_products(self):
         return list(self.products.values())
@@ -32,20 +371,752 @@ class Inventory:
     def find_by_id(self, product_id):
         return self.products.get(product_id)
 
+    def reduce_stock(self, product_id, amount):
+        product = self.find_by_id(product_id)
+        if product is None:
+            raise ValueError("Invalid product")
+        product.reduce_stock(amount)
+
+    # ordered by each category's first product, as list_products has them
+    def list_categories(self):
+        firsts = sorted((next(iter(ids)) for ids in self._categories.values()),
+                        key=self._order.__getitem__)
+        return [self.products[product_id].category for product_id in firsts]
+
+    def list_by_category(self, category):
+        ids = self._categories.get(normalize(category, self.strip_accents), ())
+        return [self.products[product_id] for product_id in ids]
+
+    def list_by_price(self, min_price=None, max_price=None, category=None,
+                      offset=0, limit=None):
+        entries = self._price_entries(category)
+        lo = 0 if min_price is None else bisect_left(entries, (min_price,))
+        hi = len(entries) if max_price is None else bisect_right(entries, (max_price, float("inf")))
+        start = lo + offset
+        end = hi if limit is None else min(hi, start + limit)
+        return [self.products[entry[2]] for entry in entries[start:end]]
+
+    def cheapest(self, k, category=None):
+        return self.list_by_price(category=category, limit=k)
+
+    def most_expensive(self, k, category=None):
+        entries = self._price_entries(category)
+        return [self.products[entry[2]] for entry in reversed(entries[max(len(entries) - k, 0):])]
+
     def search(self, keyword):
-        keyword = keyword.lower()
-        return [
-            p for p in self.products.values()
-            if keyword in p.name.lower() or keyword in p.category.lower()
-        ]
+        strip_accents = self.strip_accents
+        keyword = normalize(keyword, strip_accents)
+        pieces = tokenize(keyword)
+        if not pieces:
+            # nothing indexable (e.g. empty or punctuation only): plain scan
+            candidates = self.products.keys()
+        else:
+            candidates = None
+            for piece in sorted(set(pieces), key=len, reverse=True):
+                ids = self._ids_containing(piece)
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+
+        if len(pieces) == 1 and pieces[0] == keyword:
+            # a single word: every candidate already contains it
+            matches = [self.products[product_id] for product_id in candidates]
+        else:
+            matches = []
+            for product_id in candidates:
+                p = self.products[product_id]
+                _, name_key, category_key = p.search_keys(strip_accents)
+                if keyword in name_key or keyword in category_key:
+                    matches.append(p)
+        if len(matches) > 1:
+            matches.sort(key=lambda p: self._order[p.id])
+        return matches
+
+    # ids of products having an indexed token that contains `piece`
+    def _ids_containing(self, piece):
+        ids = set()
+        for token in self._tokens_containing(piece):
+            ids |= self._tokens[token]
+        return ids
+
+    def _tokens_containing(self, piece):
+        if len(piece) < 3:
+            # too short for the trigram index: scan the vocabulary instead
+            return [token for token in self._tokens if piece in token]
+
+        postings = []
+        for gram in trigrams(piece):
+            tokens = self._trigrams.get(gram)
+            if not tokens:
+                return []
+            postings.append(tokens)
+        postings.sort(key=len)
+        tokens = postings[0].intersection(*postings[1:])
+        return [token for token in tokens if piece in token]
+
+    def _index_text(self, product_id, name_key, category_key):
+        for token in set(tokenize(name_key) + tokenize(category_key)):
+            ids = self._tokens.get(token)
+            if ids is None:
+                ids = self._tokens[token] = set()
+                for gram in trigrams(token):
+                    self._trigrams.setdefault(gram, set()).add(token)
+            ids.add(product_id)
+
+    def _unindex_text(self, product_id, name_key, category_key):
+        for token in set(tokenize(name_key) + tokenize(category_key)):
+            ids = self._tokens.get(token)
+            if ids is None:
+                continue
+            ids.discard(product_id)
+            if not ids:
+                del self._tokens[token]
+                for gram in trigrams(token):
+                    tokens = self._trigrams[gram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._trigrams[gram]
+
+    def _index_product(self, product):
+        _, name_key, category_key = product.search_keys(self.strip_accents)
+        self._index_text(product.id, name_key, category_key)
+        self._add_to_category(product.id, category_key)
+        self._add_price(product.id, product.price, category_key)
+
+    def _unindex_product(self, product):
+        _, name_key, category_key = product.search_keys(self.strip_accents)
+        self._unindex_text(product.id, name_key, category_key)
+        self._remove_from_category(product.id, category_key)
+        self._remove_price(product.id, product.price, category_key)
+
+    def _price_entries(self, category):
+        if category is None:
+            return self._prices[None]
+        return self._prices.get(normalize(category, self.strip_accents), [])
+
+    def _add_price(self, product_id, price, category_key):
+        entry = (price, self._order[product_id], product_id)
+        if self._unsorted_prices is not None:
+            self._prices[None].append(entry)
+            self._prices.setdefault(category_key, []).append(entry)
+            self._unsorted_prices.update((None, category_key))
+        else:
+            insort(self._prices[None], entry)
+            insort(self._prices.setdefault(category_key, []), entry)
+
+    def _sort_prices(self):
+        # each list is a sorted run plus appended entries, which sort() merges cheaply
+        for key in self._unsorted_prices or ():
+            self._prices[key].sort()
+        if self._unsorted_prices:
+            self._unsorted_prices.clear()
+
+    def _remove_price(self, product_id, price, category_key):
+        if self._unsorted_prices:
+            self._sort_prices()
+        entry = (price, self._order[product_id], product_id)
+        for key in (None, category_key):
+            entries = self._prices[key]
+            del entries[bisect_left(entries, entry)]
+            if not entries and key is not None:
+                del self._prices[key]
+
+    def _on_stock_change(self, product, field, old):
+        if _RECORDED_STOCK.log is not self.log:
+            self.log.append({"type": "stock", "id": product.id, "stock": product.stock})
+
+    def _on_product_change(self, product, field, old):
+        if self.log is not None:
+            self.log.append(product_record(product))
+        if field == "price":
+            category_key = product.search_keys(self.strip_accents)[2]
+            self._remove_price(product.id, old, category_key)
+            self._add_price(product.id, product.price, category_key)
+            return
+        if field not in ("name", "category"):
+            return
+        _, name_key, category_key = product.search_keys(self.strip_accents)
+        if field == "name":
+            self._unindex_text(product.id, normalize(old, self.strip_accents), category_key)
+        else:
+            old_key = normalize(old, self.strip_accents)
+            self._unindex_text(product.id, name_key, old_key)
+            self._remove_from_category(product.id, old_key)
+            self._add_to_category(product.id, category_key)
+            self._remove_price(product.id, product.price, old_key)
+            self._add_price(product.id, product.price, category_key)
+        self._index_text(product.id, name_key, category_key)
+
+    # members stay in insertion order, like list_products, also when a
+    # product moves in from another category
+    def _add_to_category(self, product_id, category_key):
+        ids = self._categories.setdefault(category_key, {})
+        if ids and self._order[next(reversed(ids))] > self._order[product_id]:
+            ids[product_id] = None
+            self._categories[category_key] = dict.fromkeys(sorted(ids, key=self._order.__getitem__))
+        else:
+            ids[product_id] = None
+
+    def _remove_from_category(self, product_id, category_key):
+        ids = self._categories.get(category_key)
+        if ids is not None:
+            ids.pop(product_id, None)
+            if not ids:
+                del self._categories[category_key]
+
+
+#  Columnar Inventory
+#
+# Same API as Inventory, but product fields live in typed arrays (one row
+# per product) instead of one Python object per product. find_by_id,
+# search etc. hand out ProductView objects that read and write the arrays.
+
+class ProductView:
+    __slots__ = ("_inv", "_row")
+
+    def __init__(self, inventory, row):
+        self._inv = inventory
+        self._row = row
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ProductView)
+            and self._inv is other._inv and self._row == other._row
+        )
+
+    def __hash__(self):
+        return hash((id(self._inv), self._row))
+
+    @property
+    def id(self):
+        return self._inv._id_col[self._row]
+
+    @property
+    def name(self):
+        return self._inv._name_col[self._row]
+
+    @name.setter
+    def name(self, value):
+        old = self.name
+        self._inv._name_col[self._row] = value
+        self._notify("name", old)
+
+    @property
+    def category(self):
+        return self._inv._category_table[self._inv._category_col[self._row]]
+
+    @category.setter
+    def category(self, value):
+        old = self.category
+        self._inv._category_col[self._row] = self._inv._intern_category(value)
+        self._notify("category", old)
+
+    @property
+    def price(self):
+        return self._inv._price_col[self._row]
+
+    @price.setter
+    def price(self, value):
+        old = self.price
+        self._inv._price_col[self._row] = value
+        self._notify("price", old)
+
+    @property
+    def stock(self):
+        return self._inv._stock_col[self._row]
+
+    @stock.setter
+    def stock(self, value):
+        old = self.stock
+        self._inv._stock_col[self._row] = value
+        if self._inv.log is not None:
+            self._inv._on_stock_change(self, "stock", old)
+
+    def search_keys(self, strip_accents=False):
+        inv = self._inv
+        return (
+            strip_accents,
+            normalize(inv._name_col[self._row], strip_accents),
+            inv._category_keys(strip_accents)[inv._category_col[self._row]],
+        )
+
+    def subscribe(self, listener):
+        self._inv._listeners.setdefault(self._row, {})[listener] = None
+
+    def unsubscribe(self, listener):
+        listeners = self._inv._listeners.get(self._row)
+        if listeners:
+            listeners.pop(listener, None)
+
+    def _notify(self, field, old):
+        self._inv._on_product_change(self, field, old)
+        for listener in tuple(self._inv._listeners.get(self._row, ())):
+            listener(self, field, old)
+
+    def reduce_stock(self, amount):
+        with STOCK_LOCKS.lock_for(self.id):
+            if amount > self.stock:
+                raise ValueError("Not enough stock")
+            self.stock -= amount
+
+    def add_stock(self, amount):
+        with STOCK_LOCKS.lock_for(self.id):
+            self.stock += amount
+
+
+class _ColumnarProducts(Mapping):
+    def __init__(self, inventory):
+        self._inv = inventory
+
+    def __getitem__(self, product_id):
+        return ProductView(self._inv, self._inv._rows[product_id])
+
+    def __contains__(self, product_id):
+        return product_id in self._inv._rows
+
+    def __iter__(self):
+        return iter(self._inv._rows)
+
+    def __len__(self):
+        return len(self._inv._rows)
+
+
+class ColumnarInventory(Inventory):
+    def __init__(self, strip_accents=False):
+        super().__init__(strip_accents)
+        self.products = _ColumnarProducts(self)
+        self._rows = {}    # product id -> row
+        self._id_col = array("q")
+        self._price_col = array("q")
+        self._stock_col = array("q")
+        self._name_col = []
+        self._category_col = array("I")
+        self._category_table = []  # category strings, indexed by _category_col
+        self._category_index = {}  # category string -> position in the table
+        self._category_key_cache = {}
+        self._listeners = {}       # row -> listeners, only for subscribed rows
+
+    def add_product(self, product):
+        row = self._rows.get(product.id)
+        if row is not None:
+            self._unindex_product(ProductView(self, row))
+            self._name_col[row] = product.name
+            self._category_col[row] = self._intern_category(product.category)
+            self._price_col[row] = product.price
+            self._stock_col[row] = product.stock
+        else:
+            row = self._rows[product.id] = len(self._id_col)
+            self._order[product.id] = row
+            self._id_col.append(product.id)
+            self._name_col.append(product.name)
+            self._category_col.append(self._intern_category(product.category))
+            self._price_col.append(product.price)
+            self._stock_col.append(product.stock)
+        self._index_product(ProductView(self, row))
+        if self.log is not None:
+            self.log.append(product_record(product))
+
+    # views report stock changes to the inventory directly (see
+    # ProductView.stock), so there is nothing to subscribe to
+    def attach_log(self, log, write_products=False):
+        if write_products:
+            for product in self.products.values():
+                log.append(product_record(product))
+        self.log = log
+
+    def _intern_category(self, category):
+        position = self._category_index.get(category)
+        if position is None:
+            position = self._category_index[category] = len(self._category_table)
+            self._category_table.append(sys.intern(category))
+            self._category_key_cache.clear()
+        return position
+
+    # normalized category keys, parallel to _category_table
+    def _category_keys(self, strip_accents):
+        keys = self._category_key_cache.get(strip_accents)
+        if keys is None:
+            keys = self._category_key_cache[strip_accents] = [
+                sys.intern(normalize(category, strip_accents))
+                for category in self._category_table
+            ]
+        return keys
+
+
+#  Catalog loading
+
+CATALOG_FIELDS = ("id", "name", "category", "price", "stock")
+
+
+class LoadReport:
+    def __init__(self):
+        self.rows = 0
+        self.loaded = 0
+        self.errors = []  # (line number, message)
+        self.seconds = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+# int() would quietly truncate a JSON 3.7 to 3 (and take true as 1)
+def _whole_number(value):
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"not a whole number: {value!r}")
+    return int(value)
+
+
+def product_from_row(row):
+    if not isinstance(row, dict):
+        raise ValueError("malformed row")
+    missing = [field for field in CATALOG_FIELDS if row.get(field) in (None, "")]
+    if missing:
+        raise ValueError("missing " + ", ".join(missing))
+
+    try:
+        product_id = _whole_number(row["id"])
+        price = to_cents(row["price"])
+        stock = _whole_number(row["stock"])
+    except (TypeError, ValueError):
+        raise ValueError("id and stock must be whole numbers, price a number")
+    if price < 0:
+        raise ValueError("invalid price")
+    if stock < 0:
+        raise ValueError("invalid stock")
+
+    return Product(product_id, str(row["name"]), str(row["category"]), price, stock)
+
+
+def _csv_rows(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _jsonl_rows(f):
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None  # reported by product_from_row
+        yield line_no, row
+
+
+# Streams a .csv or .jsonl catalog into `inventory`, chunk_size rows at a
+# time, so memory use does not depend on the file size.
+def load_catalog(inventory, path, chunk_size=10_000):
+    rows = _jsonl_rows if path.endswith((".jsonl", ".ndjson")) else _csv_rows
+    report = LoadReport()
+    start = time.perf_counter()
+    chunk = []
+
+    with open(path, newline="", encoding="utf-8") as f:
+        for line_no, row in rows(f):
+            report.rows += 1
+            try:
+                chunk.append(product_from_row(row))
+            except ValueError as e:
+                report.errors.append((line_no, str(e)))
+            if len(chunk) >= chunk_size:
+                inventory.add_products(chunk)
+                report.loaded += len(chunk)
+                chunk = []
+    if chunk:
+        inventory.add_products(chunk)
+        report.loaded += len(chunk)
+
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+#  Binary catalog
+#
+# Layout (little endian): a header, then per-product columns
+#   ids q[n] | prices (cents) q[n] | stock q[n]
+#   string offsets Q[2n+1]  (name i starts at 2i, category i at 2i+1)
+#   key offsets Q[n+1]
+#   sorted ids q[n] | their rows Q[n]
+# then the UTF-8 strings blob and the search keys blob, which holds
+# "name_key\0category_key\0" per product. Rows keep the order products
+# were given in (Inventory's insertion order); the id index is sorted.
+
+CATALOG_MAGIC = b"SHOPCAT3"
+_CATALOG_HEADER = struct.Struct("<8sIQ")  # magic, flags, product count
+_FLAG_STRIP_ACCENTS = 1
+
+
+def write_catalog(products, path, strip_accents=False):
+    products = list(products)
+    by_id = sorted(range(len(products)), key=lambda row: products[row].id)
+    string_offsets = array("Q", [0])
+    key_offsets = array("Q", [0])
+    strings = bytearray()
+    keys = bytearray()
+    for p in products:
+        for text in (p.name, p.category):
+            strings += text.encode("utf-8")
+            string_offsets.append(len(strings))
+        _, name_key, category_key = p.search_keys(strip_accents)
+        keys += name_key.encode("utf-8") + b"\0" + category_key.encode("utf-8") + b"\0"
+        key_offsets.append(len(keys))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_CATALOG_HEADER.pack(
+            CATALOG_MAGIC, _FLAG_STRIP_ACCENTS if strip_accents else 0, len(products)
+        ))
+        f.write(array("q", [p.id for p in products]).tobytes())
+        f.write(array("q", [p.price for p in products]).tobytes())
+        f.write(array("q", [p.stock for p in products]).tobytes())
+        f.write(string_offsets.tobytes())
+        f.write(key_offsets.tobytes())
+        f.write(array("q", [products[row].id for row in by_id]).tobytes())
+        f.write(array("Q", by_id).tobytes())
+        f.write(strings)
+        f.write(keys)
+    os.replace(tmp_path, path)
+
+
+def is_binary_catalog(path):
+    with open(path, "rb") as f:
+        return f.read(len(CATALOG_MAGIC)) == CATALOG_MAGIC
+
+
+# Serves a catalog written by write_catalog straight from an mmap. Nothing
+# is parsed up front; a Product is built the first time its row is read
+# and then kept, so changes to it (stock, cart references) stick.
+class MappedInventory:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, flags, n = _CATALOG_HEADER.unpack_from(self._mm)
+        if magic != CATALOG_MAGIC:
+            raise ValueError("Not a catalog file")
+        self.strip_accents = bool(flags & _FLAG_STRIP_ACCENTS)
+        self._count = n
+
+        self._view = memoryview(self._mm)
+        pos = _CATALOG_HEADER.size
+
+        def column(fmt, length):
+            nonlocal pos
+            start, pos = pos, pos + 8 * length
+            return self._view[start:pos].cast(fmt)
+
+        self._ids = column("q", n)
+        self._prices = column("q", n)
+        self._stock = column("q", n)
+        self._string_offsets = column("Q", 2 * n + 1)
+        self._key_offsets = column("Q", n + 1)
+        self._sorted_ids = column("q", n)
+        self._id_rows = column("Q", n)
+        self._strings_start = pos
+        self._keys_start = pos + self._string_offsets[2 * n]
+        self._loaded = {}  # row -> Product
+        self._categories = None  # category key -> rows, see _category_rows
+
+    def close(self):
+        for view in (self._ids, self._prices, self._stock, self._string_offsets,
+                     self._key_offsets, self._sorted_ids, self._id_rows, self._view):
+            view.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def find_by_id(self, product_id):
+        i = bisect_left(self._sorted_ids, product_id)
+        if i < self._count and self._sorted_ids[i] == product_id:
+            return self._product(self._id_rows[i])
+        return None
+
+    def iter_products(self):
+        for row in range(self._count):
+            yield self._product(row)
+
+    def list_products(self):
+        return list(self.iter_products())
+
+    def list_categories(self):
+        return [self._string(2 * rows[0] + 1) for rows in self._category_rows().values()]
+
+    def list_by_category(self, category):
+        rows = self._category_rows().get(normalize(category, self.strip_accents), ())
+        return [self._product(row) for row in rows]
+
+    def search(self, keyword):
+        needle = normalize(keyword, self.strip_accents).encode("utf-8")
+        if not needle:
+            return self.list_products()
+        if b"\0" in needle:
+            return []
+
+        # find() runs over the whole keys blob in C; "\0" separators keep a
+        # hit inside one field, and the key offsets map it back to its row
+        start = self._keys_start
+        end = start + self._key_offsets[self._count]
+        matches = []
+        pos = self._mm.find(needle, start, end)
+        while pos != -1:
+            row = bisect_right(self._key_offsets, pos - start) - 1
+            matches.append(self._product(row))
+            pos = self._mm.find(needle, start + self._key_offsets[row + 1], end)
+        return matches
+
+    def _product(self, row):
+        product = self._loaded.get(row)
+        if product is None:
+            product = self._loaded[row] = Product(
+                self._ids[row], self._string(2 * row), self._string(2 * row + 1),
+                self._prices[row], self._stock[row],
+            )
+        return product
+
+    def _string(self, i):
+        start = self._strings_start
+        return str(self._mm[start + self._string_offsets[i]:start + self._string_offsets[i + 1]], "utf-8")
+
+    # category key -> rows in file order, built by one pass over the keys
+    # blob the first time categories are asked for
+    def _category_rows(self):
+        if self._categories is None:
+            categories = {}
+            start = self._keys_start
+            for row in range(self._count):
+                keys = self._mm[start + self._key_offsets[row]:start + self._key_offsets[row + 1]]
+                category_key = str(keys[keys.index(b"\0") + 1:-1], "utf-8")
+                categories.setdefault(category_key, array("Q")).append(row)
+            self._categories = categories
+        return self._categories
+
+
+#  Stock reservations
+#
+# Carts that use a ledger hold the stock they contain for `ttl` seconds.
+# Expiry is driven by a heap ordered by deadline, so expire() only touches
+# holds that are actually due. Refreshing a hold pushes a new heap entry;
+# the old one is recognised as stale when it is popped.
+
+class ReservationLedger:
+    def __init__(self, ttl=15 * 60, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._reserved = {}  # product id -> units held over all carts
+        self._holds = {}     # cart -> {product id: (quantity, expires_at)}
+        self._expiry = []    # heap of (expires_at, seq, cart, product id)
+        self._seq = itertools.count()
+        self._heap_lock = threading.Lock()
+        # one cart's holds span products in different stock stripes, so the
+        # per-cart dicts get a lock of their own (taken inside a stock lock)
+        self._holds_lock = threading.Lock()
+
+    def reserved(self, product_id):
+        return self._reserved.get(product_id, 0)
+
+    def held(self, cart, product_id):
+        hold = self._holds.get(cart, {}).get(product_id)
+        return hold[0] if hold else 0
+
+    def available(self, product):
+        self.expire()
+        return product.stock - self._reserved.get(product.id, 0)
+
+    # sets the cart's hold on `product` to `quantity` units (0 releases it)
+    def reserve(self, cart, product, quantity):
+        if quantity < 0:
+            raise ValueError("Quantity cannot be negative")
+        if quantity == 0:
+            self.release(cart, product.id)
+            return
+        self.expire()
+        with STOCK_LOCKS.lock_for(product.id):
+            others = self._reserved.get(product.id, 0) - self.held(cart, product.id)
+            if quantity > product.stock - others:
+                raise ValueError("Not enough stock")
+            expires_at = self.clock() + self.ttl
+            with self._holds_lock:
+                self._holds.setdefault(cart, {})[product.id] = (quantity, expires_at)
+            self._reserved[product.id] = others + quantity
+        with self._heap_lock:
+            heapq.heappush(self._expiry, (expires_at, next(self._seq), cart, product.id))
+
+    def release(self, cart, product_id):
+        with STOCK_LOCKS.lock_for(product_id):
+            self._drop(cart, product_id)
+
+    def release_all(self, cart):
+        with self._holds_lock:
+            product_ids = list(self._holds.get(cart, ()))
+        for product_id in product_ids:
+            self.release(cart, product_id)
+
+    def expire(self):
+        now = self.clock()
+        due = []
+        with self._heap_lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                due.append(heapq.heappop(self._expiry))
+        for expires_at, _, cart, product_id in due:
+            with STOCK_LOCKS.lock_for(product_id):
+                hold = self._holds.get(cart, {}).get(product_id)
+                if hold is not None and hold[1] == expires_at:
+                    self._drop(cart, product_id)
+
+    # Turns the cart's holds into nothing once checkout has decremented the
+    # stock itself; the caller holds the stock locks of the cart's products.
+    def _commit(self, cart):
+        with self._holds_lock:
+            product_ids = list(self._holds.get(cart, ()))
+        for product_id in product_ids:
+            self._drop(cart, product_id)
+
+    # caller holds the stock lock for product_id; checkout calls this after
+    # stock has moved, so it must not raise
+    def _drop(self, cart, product_id):
+        with self._holds_lock:
+            holds = self._holds.get(cart)
+            hold = holds.pop(product_id, None) if holds else None
+            if hold is None:
+                return
+            if not holds:
+                del self._holds[cart]
+        left = self._reserved.get(product_id, 0) - hold[0]
+        if left > 0:
+            self._reserved[product_id] = left
+        else:
+            self._reserved.pop(product_id, None)
 
 
 #  CartItem
 
 class CartItem:
-    def __init__(self, product, quantity):
+    __slots__ = ("product", "_quantity", "_cart")
+
+    def __init__(self, product, quantity, cart=None):
         self.product = product
-        self.quantity = quantity
+        self._quantity = quantity
+        self._cart = cart  # the ShoppingCart whose running totals include this line
+
+    @property
+    def quantity(self):
+        return self._quantity
+
+    @quantity.setter
+    def quantity(self, value):
+        old = self._quantity
+        self._quantity = value
+        if self._cart is not None:
+            price = self.product.price
+            self._cart._line_changed(self.product.id, old, price, value, price)
 
     @property
     def line_total(self):
@@ -54,9 +1125,24 @@ class CartItem:
 
 #  ShoppingCart
 
+# The cart keeps a running total, updated by every quantity change and by
+# price changes of the products in it, so calculate_total() is O(1). With
+# verify_total=True it also re-sums the lines and checks the two agree.
+# `version` changes with every change that can affect the cart's price
+# (lines, quantities, prices and categories of its products) and is never
+# shared by two carts; see QuoteCache.
+
+_CART_VERSIONS = itertools.count(1)
+
+
 class ShoppingCart:
-    def __init__(self):
+    def __init__(self, ledger=None, verify_total=False):
         self.items = {}
+        self.ledger = ledger
+        self.verify_total = verify_total
+        self._total = 0
+        self.version = next(_CART_VERSIONS)
+        self._listener = _CartListener(self)
 
     def add_item(self, product, quantity):
         if quantity > product.stock:
@@ -66,49 +1152,155 @@ class ShoppingCart:
             new_quantity = self.items[product.id].quantity + quantity
             if new_quantity > product.stock:
                 raise ValueError("Not enough stock")
+            self._reserve(product, new_quantity)
             self.items[product.id].quantity = new_quantity
         else:
-            self.items[product.id] = CartItem(product, quantity)
+            self._reserve(product, quantity)
+            self.items[product.id] = CartItem(product, quantity, self)
+            self._line_changed(product.id, 0, 0, quantity, product.price)
+            product.subscribe(self._listener)
 
     def update_quantity(self, product_id, quantity):
         if product_id not in self.items:
             raise ValueError("Item not in cart")
         if quantity > self.items[product_id].product.stock:
             raise ValueError("Not enough stock")
+        self._reserve(self.items[product_id].product, quantity)
         self.items[product_id].quantity = quantity
 
     def remove_item(self, product_id):
-        self.items.pop(product_id, None)
+        item = self.items.pop(product_id, None)
+        if item is not None:
+            self._detach(item)
+            self._line_changed(product_id, item.quantity, item.product.price, 0, 0)
+        if self.ledger is not None:
+            self.ledger.release(self, product_id)
+
+    def _reserve(self, product, quantity):
+        if self.ledger is not None:
+            self.ledger.reserve(self, product, quantity)
 
     def calculate_total(self):
-        return sum(item.line_total for item in self.items.values())
+        if self.verify_total:
+            expected = sum(item.line_total for item in self.items.values())
+            if self._total != expected:
+                raise RuntimeError(f"Cart total out of sync: {self._total} != {expected}")
+        return self._total
 
     def is_empty(self):
         return len(self.items) == 0
 
     def clear(self):
+        if self.ledger is not None:
+            self.ledger.release_all(self)
+        for item in self.items.values():
+            self._detach(item)
         self.items.clear()
+        self._total = 0
+        self.version = next(_CART_VERSIONS)
+
+    def _detach(self, item):
+        item.product.unsubscribe(self._listener)
+        item._cart = None
+
+    def _on_product_change(self, product, field, old):
+        if field == "price":
+            item = self.items.get(product.id)
+            if item is not None:
+                self._line_changed(product.id, item.quantity, old, item.quantity, product.price)
+        elif field == "category":
+            # category rules may now apply differently
+            self.version = next(_CART_VERSIONS)
+
+    def _line_changed(self, product_id, old_quantity, old_price, quantity, price):
+        self._total += quantity * price - old_quantity * old_price
+        self.version = next(_CART_VERSIONS)
+
+
+# What a cart subscribes to its products instead of a bound method, so that
+# products do not keep abandoned carts alive. Once its cart has been
+# collected, the listener unsubscribes itself on the next notification.
+class _CartListener:
+    __slots__ = ("_cart",)
+
+    def __init__(self, cart):
+        self._cart = weakref.ref(cart)
+
+    def __call__(self, product, field, old):
+        cart = self._cart()
+        if cart is None:
+            product.unsubscribe(self)
+        else:
+            cart._on_product_change(product, field, old)
 
 
 # Discount Strategy (Abstract)
+#
+# apply_many(totals) prices many totals in one call. With NumPy installed
+# it works on an int64 array and returns one; otherwise it returns a list.
 
 class DiscountStrategy(ABC):
     @abstractmethod
     def apply(self, total):
         pass
 
+    def apply_many(self, totals):
+        return [self.apply(total) for total in totals]
+
+    # Appends Python statements to `lines` that set variable `out` to this
+    # strategy's discount on variable `total`; used by DiscountPipeline.
+    # Strategies without an inline form are called through `env`. The
+    # inline forms (and the vectorized apply_many) of the built-in classes
+    # are only used for exactly those classes, so a subclass overriding
+    # apply() is always called.
+    def _emit(self, lines, env, total, out):
+        name = f"s{len(env)}"
+        env[name] = self
+        lines.append(f"{out} = {name}.apply({total})")
+
+
+def _cents_array(totals):
+    return np.asarray(totals, dtype=np.int64)
+
 
 class NoDiscount(DiscountStrategy):
     def apply(self, total):
         return 0
 
+    def _emit(self, lines, env, total, out):
+        if type(self) is not NoDiscount:
+            return super()._emit(lines, env, total, out)
+        lines.append(f"{out} = 0")
+
+    def apply_many(self, totals):
+        if type(self) is not NoDiscount:
+            return super().apply_many(totals)
+        if np is not None:
+            return np.zeros(len(totals), dtype=np.int64)
+        return [0] * len(totals)
+
 
 class PercentageDiscount(DiscountStrategy):
+    percent = _percent_property()
+
     def __init__(self, percent):
         self.percent = percent
 
     def apply(self, total):
-        return total * (self.percent / 100)
+        return percent_of(total, self._basis_points)
+
+    def _emit(self, lines, env, total, out):
+        if type(self) is not PercentageDiscount:
+            return super()._emit(lines, env, total, out)
+        lines.append(f"{out} = ({total} * {self._basis_points!r} + 5000) // 10000")
+
+    def apply_many(self, totals):
+        if type(self) is not PercentageDiscount:
+            return super().apply_many(totals)
+        bp = self._basis_points
+        if np is not None:
+            return (_cents_array(totals) * bp + 5000) // 10000
+        return [(total * bp + 5000) // 10000 for total in totals]
 
 
 class FixedAmountDiscount(DiscountStrategy):
@@ -118,68 +1310,1388 @@ class FixedAmountDiscount(DiscountStrategy):
     def apply(self, total):
         return min(total, self.amount)
 
+    def _emit(self, lines, env, total, out):
+        if type(self) is not FixedAmountDiscount:
+            return super()._emit(lines, env, total, out)
+        lines.append(f"{out} = {total} if {total} < {self.amount!r} else {self.amount!r}")
+
+    def apply_many(self, totals):
+        if type(self) is not FixedAmountDiscount:
+            return super().apply_many(totals)
+        amount = self.amount
+        if np is not None:
+            return np.minimum(_cents_array(totals), amount)
+        return [total if total < amount else amount for total in totals]
+
 
 class ThresholdPercentageDiscount(DiscountStrategy):
+    percent = _percent_property()
+
     def __init__(self, threshold, percent):
         self.threshold = threshold
         self.percent = percent
 
     def apply(self, total):
         if total >= self.threshold:
-            return total * (self.percent / 100)
+            return percent_of(total, self._basis_points)
         return 0
 
+    def _emit(self, lines, env, total, out):
+        if type(self) is not ThresholdPercentageDiscount:
+            return super()._emit(lines, env, total, out)
+        lines.append(
+            f"{out} = ({total} * {self._basis_points!r} + 5000) // 10000"
+            f" if {total} >= {self.threshold!r} else 0"
+        )
+
+    def apply_many(self, totals):
+        if type(self) is not ThresholdPercentageDiscount:
+            return super().apply_many(totals)
+        threshold = self.threshold
+        bp = self._basis_points
+        if np is not None:
+            totals = _cents_array(totals)
+            return np.where(totals >= threshold, (totals * bp + 5000) // 10000, 0)
+        return [
+            (total * bp + 5000) // 10000 if total >= threshold else 0
+            for total in totals
+        ]
+
+
+# Discount Pipeline
+#
+# Stacks several strategies:
+#   "ordered": each strategy applies to what the previous ones left
+#   "best":    every strategy sees the full total, the largest discount wins
+# and optionally caps the combined discount at `cap` cents. The whole tree
+# (nested pipelines included) is compiled once into a single flat function
+# with the strategies' constants inlined, so apply() is one call. Changes
+# made to member strategies after construction are not picked up.
+
+class DiscountPipeline(DiscountStrategy):
+    MODES = ("ordered", "best")
+
+    def __init__(self, strategies, mode="ordered", cap=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown pipeline mode: {mode}")
+        self.strategies = list(strategies)
+        self.mode = mode
+        self.cap = cap
+
+        lines = []
+        env = {}
+        self._emit(lines, env, "total", "discount")
+        self.source = "def _discount(total):\n" + "".join(
+            f"    {line}\n" for line in lines + ["return discount if discount < total else total"]
+        )
+        exec(compile(self.source, "<discount pipeline>", "exec"), env)
+        self._fn = env["_discount"]
+
+    def apply(self, total):
+        return self._fn(total)
+
+    def apply_many(self, totals):
+        fn = self._fn
+        if np is not None:
+            return np.fromiter((fn(int(t)) for t in totals), dtype=np.int64, count=len(totals))
+        return [fn(total) for total in totals]
+
+    def _emit(self, lines, env, total, out):
+        # variable names are made unique per nesting level via the env size
+        prefix = f"p{len(env)}_"
+        env[prefix] = None
+        left = prefix + "left"
+        if self.mode == "ordered":
+            lines.append(f"{out} = 0")
+            lines.append(f"{left} = {total}")
+            for i, strategy in enumerate(self.strategies):
+                step = f"{prefix}{i}"
+                strategy._emit(lines, env, left, step)
+                lines.append(f"{out} += {step}")
+                lines.append(f"{left} -= {step}")
+        else:
+            steps = []
+            for i, strategy in enumerate(self.strategies):
+                step = f"{prefix}{i}"
+                strategy._emit(lines, env, total, step)
+                steps.append(step)
+            lines.append(f"{out} = max({', '.join(steps)})" if len(steps) > 1
+                         else f"{out} = {steps[0] if steps else 0}")
+        if self.cap is not None:
+            lines.append(f"if {out} > {self.cap!r}: {out} = {self.cap!r}")
+
+
+# Item Rules
+#
+# Rules that discount individual cart lines, scoped to one product id or
+# to one category. RuleEngine indexes them by product id and category key
+# so each line only looks at the rules that can apply to it.
+
+class ItemRule(ABC):
+    def __init__(self, product_id=None, category=None):
+        if (product_id is None) == (category is None):
+            raise ValueError("A rule needs exactly one of product_id or category")
+        self.product_id = product_id
+        self.category = category
+        self.category_key = None if category is None else normalize(category)
+
+    def applies_to(self, product):
+        if self.product_id is not None:
+            return product.id == self.product_id
+        return product.search_keys()[2] == self.category_key
+
+    @abstractmethod
+    def discount(self, item):
+        pass
+
+
+class PercentageOffRule(ItemRule):
+    percent = _percent_property()
+
+    def __init__(self, percent, product_id=None, category=None):
+        super().__init__(product_id, category)
+        self.percent = percent
+
+    def discount(self, item):
+        return percent_of(item.line_total, self._basis_points)
+
+
+class BuyXGetYFreeRule(ItemRule):
+    def __init__(self, buy, free, product_id=None, category=None):
+        super().__init__(product_id, category)
+        if buy < 1 or free < 1:
+            raise ValueError("buy and free must be at least 1")
+        self.buy = buy
+        self.free = free
+
+    def discount(self, item):
+        free_units = item.quantity // (self.buy + self.free) * self.free
+        return free_units * item.product.price
+
+
+class RuleEngine:
+    # stacking: "best" gives each line its largest applicable discount,
+    # "sum" adds them all up; a line is never discounted below zero
+    def __init__(self, rules=(), stacking="best"):
+        if stacking not in ("best", "sum"):
+            raise ValueError(f"Unknown stacking: {stacking}")
+        self.stacking = stacking
+        self.version = 0        # bumped on every rule change, for QuoteCache
+        self._by_product = {}   # product id -> [rules]
+        self._by_category = {}  # category key -> [rules]
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        if rule.product_id is not None:
+            self._by_product.setdefault(rule.product_id, []).append(rule)
+        else:
+            self._by_category.setdefault(rule.category_key, []).append(rule)
+        self.version += 1
+
+    def remove_rule(self, rule):
+        if rule.product_id is not None:
+            index, key = self._by_product, rule.product_id
+        else:
+            index, key = self._by_category, rule.category_key
+        rules = index.get(key)
+        if rules and rule in rules:
+            rules.remove(rule)
+            if not rules:
+                del index[key]
+            self.version += 1
+
+    def rules_for(self, product):
+        return (
+            self._by_product.get(product.id, [])
+            + self._by_category.get(product.search_keys()[2], [])
+        )
+
+    def line_discount(self, item):
+        rules = self.rules_for(item.product)
+        if not rules:
+            return 0
+        amounts = [rule.discount(item) for rule in rules]
+        amount = max(amounts) if self.stacking == "best" else sum(amounts)
+        return min(amount, item.line_total)
+
+    # returns (total discount, {product id: line discount}) for a cart
+    def evaluate(self, cart):
+        lines = {}
+        for product_id, item in cart.items.items():
+            amount = self.line_discount(item)
+            if amount:
+                lines[product_id] = amount
+        return sum(lines.values()), lines
+
+
+# Pricing
+
+# total discount for a cart: item rules first, then the order-level strategy
+def price_cart(cart, discount_strategy, rules=None):
+    total = cart.calculate_total()
+    item_discount = rules.evaluate(cart)[0] if rules is not None else 0
+    return item_discount + discount_strategy.apply(total - item_discount)
+
+
+# QuoteCache keeps (total before, discount, total after) per cart state
+# and pricing inputs. The key is the cart's version plus the strategy and
+# rule engine objects (by identity) and the engine's version. Any cart
+# mutation, or a price or category change of a product in it, gives the
+# cart a new version, so stale quotes are never hit and simply age out of
+# the LRU.
+
+Quote = namedtuple("Quote", "total_before discount_amount total_after")
+
+
+class QuoteCache:
+    def __init__(self, maxsize=10_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def quote(self, cart, discount_strategy, rules=None):
+        key = (cart.version, discount_strategy, rules,
+               rules.version if rules is not None else None)
+        with self._lock:
+            quote = self._entries.get(key)
+            if quote is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return quote
+            self.misses += 1
+
+        total_before = cart.calculate_total()
+        discount_amount = price_cart(cart, discount_strategy, rules)
+        quote = Quote(total_before, discount_amount, total_before - discount_amount)
+        with self._lock:
+            self._entries[key] = quote
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return quote
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Order IDs
+#
+# Snowflake-style 64-bit ids: 41 bits of milliseconds since EPOCH_MS, 10
+# bits of node id and a 12-bit per-millisecond sequence. Ids from one
+# generator strictly increase; ids from different processes cannot collide
+# as long as each process uses its own node id. There is no safe default:
+# the node id is passed in or read from SHOP_NODE_ID, and assigning them is
+# up to whoever deploys the shops.
+
+class SnowflakeIdGenerator:
+    EPOCH_MS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+    def __init__(self, node_id=None, clock=time.time):
+        if node_id is None:
+            value = os.environ.get("SHOP_NODE_ID")
+            if value is None:
+                raise ValueError("node_id is required (or set SHOP_NODE_ID)")
+            try:
+                node_id = int(value)
+            except ValueError:
+                raise ValueError(f"SHOP_NODE_ID is not a number: {value!r}") from None
+        if not 0 <= node_id <= 0x3FF:
+            raise ValueError("node_id must be between 0 and 1023")
+        self.node_id = node_id
+        self._node_bits = node_id << 12
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(self._clock() * 1000) - self.EPOCH_MS
+            if now <= self._last_ms:
+                # same millisecond, or the clock stepped back: keep counting
+                # from the last millisecond handed out, moving on to the next
+                # one when its sequence runs out
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & 0xFFF
+                if self._sequence == 0:
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << 22) | self._node_bits | self._sequence
+
+
+# the old scheme: 8 hex digits of a random UUID (32 random bits)
+class UuidIdGenerator:
+    def next_id(self):
+        return str(uuid.uuid4())[:8]
+
 
 # Order
 
+# An order line as it was at checkout; orders hold these instead of live
+# CartItem/Product objects, so later price changes do not leak into history
+class OrderLine(namedtuple("OrderLine", "product_id name unit_price quantity")):
+    __slots__ = ()
+
+    @classmethod
+    def from_item(cls, item):
+        product = item.product
+        return cls(product.id, product.name, product.price, item.quantity)
+
+    @property
+    def line_total(self):
+        return self.unit_price * self.quantity
+
+
 class Order:
-    def __init__(self, items, total_before, discount_amount, total_after):
-        self.id = str(uuid.uuid4())[:8]
-        self.items = items
+    __slots__ = ("id", "items", "total_before", "discount_amount", "total_after")
+
+    # created on first use from SHOP_NODE_ID unless assigned before that
+    id_generator = None
+    _id_generator_lock = threading.Lock()
+
+    def __init__(self, items, total_before, discount_amount, total_after, order_id=None):
+        if order_id is None:
+            order_id = self._generator().next_id()
+        self.id = order_id
+        self.items = tuple(
+            item if isinstance(item, OrderLine) else OrderLine.from_item(item)
+            for item in items
+        )
         self.total_before = total_before
         self.discount_amount = discount_amount
         self.total_after = total_after
 
+    @classmethod
+    def _generator(cls):
+        generator = cls.id_generator
+        if generator is None:
+            with cls._id_generator_lock:
+                if cls.id_generator is None:
+                    cls.id_generator = SnowflakeIdGenerator()
+                generator = cls.id_generator
+        return generator
+
+    # plain data (ints, strs, lists) ready for json or any other encoder
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "items": [list(line) for line in self.items],
+            "total_before": self.total_before,
+            "discount_amount": self.discount_amount,
+            "total_after": self.total_after,
+        }
+
+    # skips __init__: recovery rebuilds every order through here
+    @classmethod
+    def from_dict(cls, data):
+        order = cls.__new__(cls)
+        order.id = data["id"]
+        order.items = tuple(map(OrderLine._make, data["items"]))
+        order.total_before = data["total_before"]
+        order.discount_amount = data["discount_amount"]
+        order.total_after = data["total_after"]
+        return order
+
+
+# Write-ahead log
+#
+# An append-only file of JSON lines, one record per line:
+#   {"lsn": n, "type": "product", "id", "name", "category", "price", "stock"}
+#   {"lsn": n, "type": "stock", "id", "stock"}
+#   {"lsn": n, "type": "checkout", "orders": [[user, order], ...], "stock": [[id, stock], ...]}
+# Stock is always logged as the new value, not the change, so applying a
+# record twice is harmless. A checkout is a single record written before
+# its stock moves, so a crash never leaves taken stock without its order.
+#
+# Lines are written by a background thread. Everything appended while one
+# write + fsync is in progress goes out together in the next one, so
+# concurrent checkouts share fsyncs instead of queueing for them.
+#
+# Records always go to `path`. rotate() renames it to `path.<last lsn>`
+# and starts a new file; take_snapshot() rotates, writes the state as of
+# that lsn (or later) to `path.snapshot` and deletes the old segments.
+
+def product_record(product):
+    return {
+        "type": "product", "id": product.id, "name": product.name,
+        "category": product.category, "price": product.price, "stock": product.stock,
+    }
+
+
+# `orders` is [(user name, Order)], `stock` is [(product id, new stock)]
+def checkout_record(orders, stock):
+    return {
+        "type": "checkout",
+        "orders": [[user, order.to_dict()] for user, order in orders],
+        "stock": [list(entry) for entry in stock],
+    }
+
+
+class OrderLog:
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.fsync = fsync
+        self.snapshot_lsn = _snapshot_lsn(self.snapshot_path)
+        self.durable_lsn = max(
+            [_repair_log(path), self.snapshot_lsn] + [lsn for lsn, _ in _segments(path)]
+        )
+        self.next_lsn = self.durable_lsn + 1
+        self.flushes = 0  # group writes done so far
+        self._file = open(path, "ab")
+        self._pending = []  # encoded lines not yet handed to the writer
+        self._rotate_at = None  # index into _pending where a rotation is due
+        self._rotations_requested = 0
+        self._rotations_done = 0  # set by the writer once a rotation is on disk
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._durable = threading.Condition(self._lock)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    # queues `record` and returns its lsn; with wait=True it only returns
+    # once the record is on disk
+    def append(self, record, wait=False):
+        body = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            if self._closed:
+                raise ValueError("Log is closed")
+            if self._error is not None:
+                raise OSError("Log write failed") from self._error
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            self._pending.append(f'{{"lsn":{lsn},{body[1:]}\n')
+            self._has_pending.notify()
+        if wait:
+            self.wait(lsn)
+        return lsn
+
+    def wait(self, lsn):
+        with self._lock:
+            while self.durable_lsn < lsn and self._error is None:
+                self._durable.wait()
+            if self.durable_lsn < lsn:
+                raise OSError("Log write failed") from self._error
+
+    # waits until everything appended so far is on disk
+    def sync(self):
+        self.wait(self.next_lsn - 1)
+
+    # ends the current segment after the last record appended so far and
+    # returns that record's lsn once the segment is closed
+    def rotate(self):
+        with self._lock:
+            if self._closed:
+                raise ValueError("Log is closed")
+            while self._rotate_at is not None and self._error is None:
+                self._durable.wait()
+            if self._error is not None:
+                raise OSError("Log write failed") from self._error
+            lsn = self.next_lsn - 1
+            self._rotate_at = len(self._pending)
+            self._rotations_requested += 1
+            rotation = self._rotations_requested
+            self._has_pending.notify()
+            while self._rotations_done < rotation and self._error is None:
+                self._durable.wait()
+            if self._rotations_done < rotation:
+                raise OSError("Log write failed") from self._error
+        return lsn
+
+    # deletes the segments a snapshot has made redundant
+    def compact(self):
+        for lsn, segment in _segments(self.path):
+            if lsn <= self.snapshot_lsn:
+                os.remove(segment)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._has_pending.notify()
+        self._writer.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending and self._rotate_at is None and not self._closed:
+                    self._has_pending.wait()
+                if not self._pending and self._rotate_at is None:
+                    return
+                lines, self._pending = self._pending, []
+                rotate_at, self._rotate_at = self._rotate_at, None
+                rotation = self._rotations_requested
+                lsn = self.next_lsn - 1
+            try:
+                if rotate_at is not None:
+                    self._write(lines[:rotate_at])
+                    lines = lines[rotate_at:]
+                    # an empty segment has nothing to keep, and its name
+                    # would be that of the segment before it
+                    if self._file.tell():
+                        self._rotate(f"{self.path}.{lsn - len(lines)}")
+                self._write(lines)
+            except OSError as e:
+                with self._lock:
+                    self._error = e
+                    self._durable.notify_all()
+                return
+            with self._lock:
+                self.durable_lsn = lsn
+                self._rotations_done = rotation
+                self.flushes += 1
+                self._durable.notify_all()
+
+    def _rotate(self, segment):
+        if os.path.exists(segment):
+            raise FileExistsError(f"Log segment {segment} already exists")
+        self._file.close()
+        os.replace(self.path, segment)
+        self._file = open(self.path, "ab")
+        if self.fsync:
+            _fsync_dir(self.path)
+
+    def _write(self, lines):
+        if lines:
+            self._file.write("".join(lines).encode("utf-8"))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+
+# Cuts off a torn last line (a write interrupted by a crash) and returns
+# the lsn of the last complete record, or 0 for a missing or empty log.
+def _repair_log(path):
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = pos = f.seek(0, os.SEEK_END)
+        tail = b""
+        while pos > 0 and tail.count(b"\n") < 2:
+            step = min(1 << 16, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+        cut = tail.rfind(b"\n") + 1
+        if pos + cut < end:
+            f.truncate(pos + cut)
+        lines = tail[:cut].splitlines()
+        return json.loads(lines[-1])["lsn"] if lines else 0
+
+
+# old segments as [(lsn of their last record, file name)], oldest first
+def _segments(path):
+    directory, base = os.path.split(os.path.abspath(path))
+    found = []
+    for name in os.listdir(directory):
+        suffix = name[len(base) + 1:]
+        if name.startswith(base + ".") and suffix.isdigit():
+            found.append((int(suffix), os.path.join(directory, name)))
+    found.sort()
+    return found
+
+
+def _snapshot_lsn(snapshot_path):
+    try:
+        with open(snapshot_path, encoding="utf-8") as f:
+            return json.loads(f.readline())["lsn"]
+    except FileNotFoundError:
+        return 0
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Rebuilds state from the log at `path`: the snapshot if there is one, then
+# every later record in the old segments and in `path` itself. Returns
+# (inventory, orders), where orders maps user name -> [Order] in checkout
+# order. Products go into `inventory` (a new Inventory by default) in one
+# add_products call.
+def replay_log(path, inventory=None):
+    if inventory is None:
+        inventory = Inventory()
+    products = {}
+    orders = {}
+    snapshot_orders = set()  # ids of orders the snapshot already had
+    start = _snapshot_lsn(path + ".snapshot")
+    # nothing built here has reference cycles; left on, the cycle collector
+    # would rescan the growing order history over and over
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if os.path.exists(path + ".snapshot"):
+            with open(path + ".snapshot", encoding="utf-8") as f:
+                _replay_file(f, path + ".snapshot", 0, products, orders, snapshot_orders)
+        for lsn, segment in _segments(path):
+            if lsn > start:
+                with open(segment, encoding="utf-8") as f:
+                    _replay_file(f, segment, start, products, orders, snapshot_orders)
+        try:
+            with open(path, encoding="utf-8") as f:
+                _replay_file(f, path, start, products, orders, snapshot_orders)
+        except FileNotFoundError:
+            pass
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    inventory.add_products(products.values())
+    return inventory, orders
+
+
+def _replay_file(f, name, start, products, orders, snapshot_orders):
+    for line_no, line in enumerate(f, 1):
+        if not line.endswith("\n"):
+            break  # torn last write
+        try:
+            record = json.loads(line)
+            if record.get("lsn", start + 1) <= start:
+                continue
+            kind = record["type"]
+            if kind == "snapshot":
+                pass
+            elif kind == "product":
+                products[record["id"]] = Product(
+                    record["id"], record["name"], record["category"],
+                    record["price"], record["stock"],
+                )
+            elif kind == "stock":
+                products[record["id"]].stock = record["stock"]
+            elif kind == "checkout":
+                for user, order in record["orders"]:
+                    if order["id"] not in snapshot_orders:
+                        orders.setdefault(user, []).append(Order.from_dict(order))
+                for product_id, stock in record["stock"]:
+                    products[product_id].stock = stock
+            elif kind == "orders":  # snapshot only
+                snapshot_orders.update(order["id"] for order in record["orders"])
+                orders.setdefault(record["user"], []).extend(
+                    Order.from_dict(order) for order in record["orders"]
+                )
+            else:
+                raise ValueError(f"unknown record type {kind!r}")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"{name} line {line_no}: bad log record ({e})") from e
+
+
+# Snapshots
+#
+# take_snapshot() does not stop checkouts. It rotates the log at some lsn,
+# waits until every change logged up to there has also been applied in
+# memory, then copies products and order histories while checkouts carry
+# on. The copy may already contain some later changes; those are replayed
+# again on recovery, which is harmless (stock is logged as absolute values
+# and orders the snapshot already has are skipped).
+
+# `users` must be every user logging to `log`: orders of users left out
+# are lost once the old segments are compacted away
+def take_snapshot(log, inventory, users):
+    lsn = log.rotate()
+    # records are appended under the stock locks of what they change (or
+    # after the change is made), and orders join users' histories before
+    # those locks are released
+    STOCK_LOCKS.barrier()
+    products = list(inventory.products.values())
+    histories = [(user.name, list(user.orders)) for user in users]
+
+    tmp_path = log.snapshot_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "snapshot", "lsn": lsn}) + "\n")
+        for product in products:
+            f.write(json.dumps(product_record(product), separators=(",", ":")) + "\n")
+        for name, history in histories:
+            for i in range(0, len(history), 1_000):
+                record = {
+                    "type": "orders", "user": name,
+                    "orders": [order.to_dict() for order in history[i:i + 1_000]],
+                }
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    # the copy may include changes logged after lsn; their records must be
+    # on disk before the snapshot can be relied on
+    log.sync()
+    os.replace(tmp_path, log.snapshot_path)
+    _fsync_dir(log.snapshot_path)
+    log.snapshot_lsn = lsn
+    log.compact()
+    return lsn
+
+
+# Takes a snapshot every `interval` seconds, as long as at least
+# `min_records` records were logged since the previous one.
+class Checkpointer:
+    def __init__(self, log, inventory, users, interval=60.0, min_records=10_000):
+        self.log = log
+        self.inventory = inventory
+        self.users = users
+        self.interval = interval
+        self.min_records = min_records
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    # a failed snapshot leaves the log and the previous snapshot as they
+    # were, so report it and try again next interval
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.log.next_lsn - 1 - self.log.snapshot_lsn >= self.min_records:
+                try:
+                    take_snapshot(self.log, self.inventory, self.users)
+                except Exception as e:
+                    self.last_error = e
+                    print(f"Snapshot of {self.log.path} failed: {e!r}", file=sys.stderr)
+
+
+# SQLite storage
+#
+# SQLiteInventory keeps products and orders in a SQLite database, so the
+# catalog and order history need not fit in memory. Reads have the same
+# API as Inventory. A Product is built when a query returns its row and
+# lives only as long as something references it; while it does, every
+# query hands out that same object and its changes are written back.
+#
+# Writes are queued and go to the database in batches (executemany inside
+# one transaction). The inventory is also a log for User and
+# batch_checkout: append() queues a checkout, and wait() commits everything
+# queued so far, by every thread, in a single transaction. If a write or
+# the commit fails, the transaction is rolled back and its writes are
+# queued again, so nothing is half saved and the next commit retries them.
+# That retry goes one write at a time: a write SQLite still rejects is
+# dropped and kept in dropped_writes rather than failing every later
+# commit (and every read, since reads flush the queue first).
+#
+# Order ids are whatever Order.id_generator hands out (ints from
+# SnowflakeIdGenerator, strs from UuidIdGenerator), so the id columns have
+# no declared type and keep either.
+
+def _is_int64(value):
+    return isinstance(value, int) and -1 << 63 <= value < 1 << 63
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    stock INTEGER NOT NULL,
+    name_key TEXT NOT NULL,
+    category_key TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS products_seq ON products (seq);
+CREATE INDEX IF NOT EXISTS products_category ON products (category_key, seq);
+CREATE INDEX IF NOT EXISTS products_price ON products (price, seq);
+CREATE INDEX IF NOT EXISTS products_category_price ON products (category_key, price, seq);
+CREATE TABLE IF NOT EXISTS orders (
+    id NOT NULL PRIMARY KEY,
+    user TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    total_before INTEGER NOT NULL,
+    discount_amount INTEGER NOT NULL,
+    total_after INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS orders_user_time ON orders (user, created_at);
+CREATE INDEX IF NOT EXISTS orders_time ON orders (created_at);
+CREATE TABLE IF NOT EXISTS order_lines (
+    order_id NOT NULL REFERENCES orders (id),
+    line INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    unit_price INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    PRIMARY KEY (order_id, line)
+) WITHOUT ROWID;
+"""
+
+# the statements are fixed strings, so sqlite3's statement cache prepares
+# each of them once per connection
+_PRODUCT_COLUMNS = "id, name, category, price, stock"
+_SQL_UPSERT_PRODUCT = """
+    INSERT INTO products (id, seq, name, category, price, stock, name_key, category_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name, category = excluded.category, price = excluded.price,
+        stock = excluded.stock, name_key = excluded.name_key,
+        category_key = excluded.category_key
+"""
+_SQL_UPDATE_PRODUCT = """
+    UPDATE products SET name = ?, category = ?, price = ?, name_key = ?, category_key = ?
+    WHERE id = ?
+"""
+_SQL_UPDATE_STOCK = "UPDATE products SET stock = ? WHERE id = ?"
+_SQL_INSERT_ORDER = "INSERT OR IGNORE INTO orders VALUES (?, ?, ?, ?, ?, ?)"
+_SQL_INSERT_LINE = "INSERT OR IGNORE INTO order_lines VALUES (?, ?, ?, ?, ?, ?)"
+_SQL_FIND = f"SELECT {_PRODUCT_COLUMNS} FROM products WHERE id = ?"
+_SQL_ALL = f"SELECT {_PRODUCT_COLUMNS} FROM products ORDER BY seq"
+_SQL_SEARCH = f"""
+    SELECT {_PRODUCT_COLUMNS} FROM products
+    WHERE instr(name_key, ?1) OR instr(category_key, ?1) ORDER BY seq
+"""
+_SQL_CATEGORIES = """
+    SELECT category, min(seq) AS first FROM products GROUP BY category_key ORDER BY first
+"""
+_SQL_BY_CATEGORY = f"SELECT {_PRODUCT_COLUMNS} FROM products WHERE category_key = ? ORDER BY seq"
+_SQL_ORDERS = """
+    SELECT o.id, o.total_before, o.discount_amount, o.total_after,
+           l.product_id, l.name, l.unit_price, l.quantity
+    FROM orders o JOIN order_lines l ON l.order_id = o.id
+    WHERE {where} ORDER BY o.created_at, o.id, l.line
+"""
+
+
+class SQLiteInventory:
+    # synchronous="FULL" makes every commit durable; "NORMAL" is faster and
+    # in WAL mode can only lose the last commits on power loss
+    def __init__(self, path, strip_accents=False, synchronous="FULL", batch_size=1_000):
+        self.strip_accents = strip_accents
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute(f"PRAGMA synchronous = {synchronous}")
+        self._conn.executescript(_SQLITE_SCHEMA)
+        stored = self._conn.execute("SELECT value FROM meta WHERE key = 'strip_accents'").fetchone()
+        if stored is None:
+            self._conn.execute("INSERT INTO meta VALUES ('strip_accents', ?)", (str(int(strip_accents)),))
+            self._conn.commit()
+        elif stored[0] != str(int(strip_accents)):
+            raise ValueError("Database was built with a different strip_accents setting")
+        self._next_seq = self._conn.execute("SELECT coalesce(max(seq), -1) + 1 FROM products").fetchone()[0]
+
+        # _conn_lock serializes use of the connection; _lock guards the
+        # queues below and is never held across a database call, so stock
+        # changes and checkouts do not wait for a commit in progress
+        self._conn_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._loaded = weakref.WeakValueDictionary()  # product id -> Product
+        self._changed = {}  # product id -> Product with unsaved name/category/price
+        self._stock = {}    # product id -> unsaved stock
+        self._orders = []   # unsaved [(user, order dict, created_at ms)]
+        self._unsaved = []  # (changed, orders, stock) flushed since the last commit
+        self._retrying = False  # the queues hold writes of a failed transaction
+        self.dropped_writes = []  # (what, error) for writes given up on
+        self._next_lsn = 1
+        self._committed_lsn = 0
+
+    def close(self):
+        with self._conn_lock:
+            self._commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._query("SELECT count(*) FROM products")[0][0]
+
+    def add_product(self, product):
+        self.add_products((product,))
+
+    # rows go in batch_size at a time with executemany, all in one transaction
+    def add_products(self, products):
+        with self._conn_lock:
+            self._flush()
+            batch = []
+            try:
+                for product in products:
+                    with self._lock:
+                        old = self._loaded.get(product.id)
+                        if old is not None and old is not product:
+                            old.unsubscribe(self._on_product_change)
+                            old.unsubscribe_stock(self._on_stock_change)
+                        self._register(product)
+                    _, name_key, category_key = product.search_keys(self.strip_accents)
+                    batch.append((
+                        product.id, self._next_seq, product.name, product.category,
+                        product.price, product.stock, name_key, category_key,
+                    ))
+                    self._next_seq += 1
+                    if len(batch) >= self.batch_size:
+                        self._conn.executemany(_SQL_UPSERT_PRODUCT, batch)
+                        batch.clear()
+                self._conn.executemany(_SQL_UPSERT_PRODUCT, batch)
+            except BaseException:
+                self._rollback()
+                raise
+            self._commit()
+
+    def find_by_id(self, product_id):
+        product = self._loaded.get(product_id)
+        if product is not None:
+            return product
+        rows = self._query(_SQL_FIND, (product_id,))
+        return self._products(rows)[0] if rows else None
+
+    def reduce_stock(self, product_id, amount):
+        product = self.find_by_id(product_id)
+        if product is None:
+            raise ValueError("Invalid product")
+        product.reduce_stock(amount)
+
+    def list_products(self):
+        return self._products(self._query(_SQL_ALL))
+
+    def list_categories(self):
+        return [category for category, _ in self._query(_SQL_CATEGORIES)]
+
+    def list_by_category(self, category):
+        key = normalize(category, self.strip_accents)
+        return self._products(self._query(_SQL_BY_CATEGORY, (key,)))
+
+    def list_by_price(self, min_price=None, max_price=None, category=None,
+                      offset=0, limit=None):
+        where, params = self._price_filter(min_price, max_price, category)
+        rows = self._query(
+            f"SELECT {_PRODUCT_COLUMNS} FROM products {where} ORDER BY price, seq LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset],
+        )
+        return self._products(rows)
+
+    def cheapest(self, k, category=None):
+        return self.list_by_price(category=category, limit=k)
+
+    def most_expensive(self, k, category=None):
+        where, params = self._price_filter(None, None, category)
+        rows = self._query(
+            f"SELECT {_PRODUCT_COLUMNS} FROM products {where} ORDER BY price DESC, seq DESC LIMIT ?",
+            params + [k],
+        )
+        return self._products(rows)
+
+    # substring match on the normalized name and category, like Inventory
+    def search(self, keyword):
+        return self._products(self._query(_SQL_SEARCH, (normalize(keyword, self.strip_accents),)))
+
+    # orders in checkout order, optionally only one user's and/or only those
+    # placed at or after `since` (a time.time() timestamp)
+    def list_orders(self, user=None, since=None):
+        clauses, params = [], []
+        if user is not None:
+            clauses.append("o.user = ?")
+            params.append(user)
+        if since is not None:
+            clauses.append("o.created_at >= ?")
+            params.append(int(since * 1000))
+        rows = self._query(_SQL_ORDERS.format(where=" AND ".join(clauses) or "1"), params)
+        orders = []
+        for _, lines in itertools.groupby(rows, key=lambda row: row[0]):
+            lines = list(lines)
+            order_id, total_before, discount_amount, total_after = lines[0][:4]
+            orders.append(Order(
+                [OrderLine(*line[4:]) for line in lines],
+                total_before, discount_amount, total_after, order_id=order_id,
+            ))
+        return orders
+
+    # the log interface used by User and batch_checkout (see OrderLog)
+    def append(self, record, wait=False):
+        if record["type"] != "checkout":
+            raise ValueError(f"Unsupported record type {record['type']!r}")
+        created_at = int(time.time() * 1000)
+        # checked before anything is queued: callers append before they
+        # move any stock
+        for _, order in record["orders"]:
+            order_id = order["id"]
+            if not (isinstance(order_id, str) or _is_int64(order_id)):
+                raise ValueError(f"Cannot store order id {order_id!r}")
+            amounts = [order["total_before"], order["discount_amount"], order["total_after"]]
+            for product_id, _, unit_price, quantity in order["items"]:
+                amounts += (product_id, unit_price, quantity)
+            if not all(map(_is_int64, amounts)):
+                raise ValueError(f"Order {order_id!r} has amounts too large to store")
+        for product_id, stock in record["stock"]:
+            if not _is_int64(stock):
+                raise ValueError(f"Cannot store stock {stock!r} of product {product_id}")
+        with self._lock:
+            for user, order in record["orders"]:
+                self._orders.append((user, order, created_at))
+            for product_id, stock in record["stock"]:
+                self._stock[product_id] = stock
+            lsn = self._next_lsn
+            self._next_lsn += 1
+        if wait:
+            self.wait(lsn)
+        return lsn
+
+    # whoever gets the connection first commits for everyone queued so far
+    def wait(self, lsn):
+        with self._conn_lock:
+            if self._committed_lsn < lsn:
+                self._commit()
+
+    def sync(self):
+        with self._conn_lock:
+            self._commit()
+
+    def _query(self, sql, params=()):
+        with self._conn_lock:
+            self._flush()
+            return self._conn.execute(sql, params).fetchall()
+
+    def _price_filter(self, min_price, max_price, category):
+        clauses, params = [], []
+        if min_price is not None:
+            clauses.append("price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            clauses.append("price <= ?")
+            params.append(max_price)
+        if category is not None:
+            clauses.append("category_key = ?")
+            params.append(normalize(category, self.strip_accents))
+        return ("WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def _products(self, rows):
+        with self._lock:
+            return [self._product(row) for row in rows]
+
+    # _lock must be held
+    def _product(self, row):
+        product = self._loaded.get(row[0])
+        if product is None:
+            product = Product(*row)
+            self._register(product)
+        return product
+
+    def _register(self, product):
+        self._loaded[product.id] = product
+        product.subscribe(self._on_product_change)
+        product.subscribe_stock(self._on_stock_change)
+
+    def _on_product_change(self, product, field, old):
+        with self._lock:
+            self._changed[product.id] = product
+
+    # runs under the product's stock lock, so per product the queued values
+    # keep the order the changes were made in
+    def _on_stock_change(self, product, field, old):
+        if _RECORDED_STOCK.log is self:
+            return
+        with self._lock:
+            self._stock[product.id] = product.stock
+
+    # sends queued writes to the open transaction (_conn_lock must be held)
+    # and returns the last lsn they cover; reads on this connection see them
+    # before they are committed
+    def _flush(self):
+        with self._lock:
+            changed, self._changed = self._changed, {}
+            orders, self._orders = self._orders, []
+            stock, self._stock = self._stock, {}
+            lsn = self._next_lsn - 1
+        self._unsaved.append((changed, orders, stock))
+        retrying, self._retrying = self._retrying, False
+        try:
+            if retrying:
+                self._write_each(changed, orders, stock)
+            else:
+                self._write(changed, orders, stock)
+        except BaseException:
+            self._rollback()
+            raise
+        return lsn
+
+    def _write(self, changed, orders, stock):
+        if changed:
+            rows = []
+            for product in changed.values():
+                _, name_key, category_key = product.search_keys(self.strip_accents)
+                rows.append((product.name, product.category, product.price,
+                             name_key, category_key, product.id))
+            self._conn.executemany(_SQL_UPDATE_PRODUCT, rows)
+        if orders:
+            self._conn.executemany(_SQL_INSERT_ORDER, [
+                (order["id"], user, created_at, order["total_before"],
+                 order["discount_amount"], order["total_after"])
+                for user, order, created_at in orders
+            ])
+            self._conn.executemany(_SQL_INSERT_LINE, [
+                (order["id"], i, *line)
+                for _, order, _ in orders
+                for i, line in enumerate(order["items"])
+            ])
+        if stock:
+            self._conn.executemany(_SQL_UPDATE_STOCK, [(value, product_id) for product_id, value in stock.items()])
+
+    # writes each queued change in a savepoint of its own and drops those
+    # SQLite rejects (bad values, constraint failures); errors of the
+    # database itself (I/O, locking) still fail the whole transaction
+    def _write_each(self, changed, orders, stock):
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+        units = (
+            [(changed, product_id, ({product_id: product}, [], {}))
+             for product_id, product in changed.items()] +
+            [(orders, entry, ({}, [entry], {})) for entry in orders] +
+            [(stock, product_id, ({}, [], {product_id: value}))
+             for product_id, value in stock.items()]
+        )
+        for queue, key, unit in units:
+            self._conn.execute("SAVEPOINT unit")
+            try:
+                self._write(*unit)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                self._conn.execute("ROLLBACK TO unit")
+                if queue is orders:
+                    orders.remove(key)
+                else:
+                    del queue[key]
+                self.dropped_writes.append((unit, e))
+                print(f"Dropped a write SQLite rejected twice: {e!r}", file=sys.stderr)
+            self._conn.execute("RELEASE unit")
+
+    def _commit(self):
+        lsn = self._flush()
+        try:
+            self._conn.commit()
+        except BaseException:
+            self._rollback()
+            raise
+        self._unsaved.clear()
+        self._committed_lsn = lsn
+
+    # drops the open transaction and queues its writes again, ahead of
+    # (and overwritten by) anything queued since
+    def _rollback(self):
+        self._conn.rollback()
+        with self._lock:
+            for changed, orders, stock in reversed(self._unsaved):
+                changed.update(self._changed)
+                stock.update(self._stock)
+                self._changed, self._orders, self._stock = changed, orders + self._orders, stock
+            self._retrying = True
+        self._unsaved.clear()
+
 
 # User
 
+# With a log (normally the OrderLog attached to the inventory), checkout
+# only returns once its order is durable.
 class User:
-    def __init__(self, name):
+    def __init__(self, name, ledger=None, log=None):
         self.name = name
-        self.cart = ShoppingCart()
+        self.cart = ShoppingCart(ledger)
         self.orders = []
+        self.log = log
 
-    def checkout(self, discount_strategy):
+    # `rules` is an optional RuleEngine; its line discounts come off first
+    # and discount_strategy then applies to what is left
+    def checkout(self, discount_strategy, rules=None):
         if self.cart.is_empty():
             raise ValueError("Cart is empty")
 
         total_before = self.cart.calculate_total()
-        discount_amount = discount_strategy.apply(total_before)
+        discount_amount = price_cart(self.cart, discount_strategy, rules)
         total_after = total_before - discount_amount
 
-        # reduce inventory stock
-        for item in self.cart.items.values():
-            item.product.reduce_stock(item.quantity)
-
-        order = Order(
-            items=list(self.cart.items.values()),
-            total_before=total_before,
-            discount_amount=discount_amount,
-            total_after=total_after
-        )
-
-        self.orders.append(order)
+        # reduce inventory stock, all or nothing: check every line first and
+        # only then decrement, all while holding the stock locks. Stock held
+        # for this cart counts as available, stock held for other carts does
+        # not. Holds that have expired are dropped first, so they count as
+        # no hold.
+        items = list(self.cart.items.values())
+        ledger = self.cart.ledger
+        if ledger is not None:
+            ledger.expire()
+        lsn = None
+        with STOCK_LOCKS.holding(self.cart.items):
+            for item in items:
+                available = item.product.stock
+                if ledger is not None:
+                    available -= ledger.reserved(item.product.id) - ledger.held(self.cart, item.product.id)
+                if item.quantity > available:
+                    raise ValueError("Not enough stock")
+
+            order = Order(
+                items=items,
+                total_before=total_before,
+                discount_amount=discount_amount,
+                total_after=total_after
+            )
+            if self.log is not None:
+                lsn = self.log.append(checkout_record(
+                    [(self.name, order)],
+                    [(item.product.id, item.product.stock - item.quantity) for item in items],
+                ))
+
+            _RECORDED_STOCK.log = self.log
+            try:
+                for item in items:
+                    item.product.stock -= item.quantity
+            finally:
+                _RECORDED_STOCK.log = None
+            if ledger is not None:
+                ledger._commit(self.cart)
+            self.orders.append(order)
+
+        # the order is placed now, so the cart goes before waiting: if the
+        # wait fails the error only means the order may not be on disk, and
+        # checking out again must not place it twice
         self.cart.clear()
+        # wait outside the locks, so other checkouts can join the same fsync
+        if lsn is not None:
+            self.log.wait(lsn)
 
         return order
 
 
+# Batch Checkout
+#
+# Checks out many users at once: demand is summed per product, stock is
+# allocated to users in arrival order (each user gets their whole cart or
+# nothing), and each product's stock is written once for the whole batch.
+
+class BatchResult:
+    def __init__(self):
+        self.orders = []    # in the order the users were given
+        self.rejected = []  # (user, reason)
+
+
+def batch_checkout(users, discount_strategy, rules=None):
+    result = BatchResult()
+    if len(set(users)) != len(users):
+        raise ValueError("Users in a batch must be distinct")
+    ledgers = {user.cart.ledger for user in users} - {None}
+    if len(ledgers) > 1:
+        raise ValueError("Carts in a batch must share a ledger")
+    ledger = ledgers.pop() if ledgers else None
+    if ledger is not None:
+        ledger.expire()  # takes stock locks itself, so before holding any
+    logs = {user.log for user in users} - {None}
+    if len(logs) > 1:
+        raise ValueError("Users in a batch must share a log")
+    log = logs.pop() if logs else None
+
+    products = {}
+    demand = {}
+    quotes = {}  # user -> (total before, discount)
+    for user in users:
+        for product_id, item in user.cart.items.items():
+            products[product_id] = item.product
+            demand[product_id] = demand.get(product_id, 0) + item.quantity
+        if not user.cart.is_empty():
+            total_before = user.cart.calculate_total()
+            quotes[user] = (total_before, price_cart(user.cart, discount_strategy, rules))
+
+    accepted = []
+    lsn = None
+    with STOCK_LOCKS.holding(products):
+        # unreserved stock each product can still hand out
+        free = {
+            product_id: product.stock - (ledger.reserved(product_id) if ledger else 0)
+            for product_id, product in products.items()
+        }
+        # products whose unreserved stock covers the whole batch need no
+        # per-user bookkeeping
+        contested = {
+            product_id for product_id, quantity in demand.items()
+            if quantity > free[product_id]
+        }
+
+        taken = dict.fromkeys(products, 0)
+        for user in users:
+            cart = user.cart
+            if cart.is_empty():
+                result.rejected.append((user, "Cart is empty"))
+                continue
+            needs = []
+            for product_id in contested.intersection(cart.items):
+                quantity = cart.items[product_id].quantity
+                if ledger is not None:
+                    quantity = max(0, quantity - ledger.held(cart, product_id))
+                needs.append((product_id, quantity))
+            if any(quantity > free[product_id] for product_id, quantity in needs):
+                result.rejected.append((user, "Not enough stock"))
+                continue
+            for product_id, quantity in needs:
+                free[product_id] -= quantity
+            for product_id, item in cart.items.items():
+                taken[product_id] += item.quantity
+            accepted.append(user)
+
+        for user in accepted:
+            total_before, discount_amount = quotes[user]
+            result.orders.append(Order(
+                items=user.cart.items.values(),
+                total_before=total_before,
+                discount_amount=discount_amount,
+                total_after=total_before - discount_amount
+            ))
+        # the whole batch is one log record, written before any stock moves
+        if log is not None and accepted:
+            lsn = log.append(checkout_record(
+                [(user.name, order) for user, order in zip(accepted, result.orders)],
+                [(product_id, products[product_id].stock - quantity)
+                 for product_id, quantity in taken.items() if quantity],
+            ))
+
+        _RECORDED_STOCK.log = log
+        try:
+            for product_id, quantity in taken.items():
+                if quantity:
+                    products[product_id].stock -= quantity
+        finally:
+            _RECORDED_STOCK.log = None
+        if ledger is not None:
+            for user in accepted:
+                ledger._commit(user.cart)
+        for user, order in zip(accepted, result.orders):
+            user.orders.append(order)
+
+    # as in User.checkout: the orders are placed, clear before waiting
+    for user in accepted:
+        user.cart.clear()
+    if lsn is not None:
+        log.wait(lsn)
+
+    return result
+
+
 # CLI Helpers
 
 def print_products(products):
     print("\n=== Product List ===")
     for p in products:
-        print(f"{p.id}) {p.name} | Category: {p.category} | Price: {p.price} | Stock: {p.stock}")
+        print(f"{p.id}) {p.name} | Category: {p.category} | Price: {format_money(p.price)} | Stock: {p.stock}")
     print()
 
 
@@ -190,8 +2702,8 @@ def print_cart(cart):
 
     print("\n=== Cart ===")
     for item in cart.items.values():
-        print(f"{item.product.name} | Qty: {item.quantity} | Line Total: {item.line_total}")
-    print(f"Total: {cart.calculate_total()}\n")
+        print(f"{item.product.name} | Qty: {item.quantity} | Line Total: {format_money(item.line_total)}")
+    print(f"Total: {format_money(cart.calculate_total())}\n")
 
 
 def print_orders(orders):
@@ -203,23 +2715,91 @@ def print_orders(orders):
     for o in orders:
         print("-------------------------")
         print(f"Order ID: {o.id}")
-        for item in o.items:
-            print(f"- {item.product.name} x {item.quantity}")
-        print(f"Total Before: {o.total_before}")
-        print(f"Discount: {o.discount_amount}")
-        print(f"Total After: {o.total_after}")
+        for line in o.items:
+            print(f"- {line.name} x {line.quantity}")
+        print(f"Total Before: {format_money(o.total_before)}")
+        print(f"Discount: {format_money(o.discount_amount)}")
+        print(f"Total After: {format_money(o.total_after)}")
     print("-------------------------\n")
 
 
+# removes "--name value" from args and returns value (None if absent)
+def pop_option(args, name):
+    if name not in args:
+        return None
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
 # Main Program
 
 def main():
-    inv = Inventory()
-    inv.add_product(Product(1, "Tablet", "Digital", 2000, 5))
-    inv.add_product(Product(2, "Computer", "Digital", 4000, 3))
-    inv.add_product(Product(3, "Mouse", "Accessory", 550, 10))
-
-    user = User("Default User")
+    # usage: [catalog] [--log PATH | --db PATH] [--node-id N]; an existing
+    # log or database replaces the catalog
+    args = sys.argv[1:]
+    log_path = pop_option(args, "--log")
+    db_path = pop_option(args, "--db")
+    node_id = pop_option(args, "--node-id")
+    if log_path and db_path:
+        print("Use either --log or --db")
+        return
+    try:
+        Order.id_generator = SnowflakeIdGenerator(None if node_id is None else int(node_id))
+    except ValueError as e:
+        if log_path or db_path:
+            print(f"{e}; order ids must be unique across shops sharing a store")
+            return
+        # orders are not kept anywhere else, so any node id will do
+        Order.id_generator = SnowflakeIdGenerator(0)
+
+    inv = SQLiteInventory(db_path) if db_path else Inventory()
+    orders = {}
+    # anything durable (a snapshot, old segments or the current file) means
+    # the shop has run before
+    log = OrderLog(log_path) if log_path else None
+    if log is not None and log.durable_lsn:
+        inv, orders = replay_log(log_path)
+        print(f"Recovered {len(inv.products)} products and "
+              f"{sum(map(len, orders.values()))} orders from {log_path}")
+    elif db_path and len(inv):
+        print(f"Opened {len(inv)} products from {db_path}")
+    elif args and is_binary_catalog(args[0]):
+        if db_path:
+            with MappedInventory(args[0]) as mapped:
+                inv.add_products(mapped.iter_products())
+        else:
+            inv = MappedInventory(args[0])
+        print(f"Opened {len(inv)} products from {args[0]}")
+    elif args:
+        report = load_catalog(inv, args[0])
+        print(f"Loaded {report.loaded} products from {report.rows} rows "
+              f"in {report.seconds:.2f}s ({report.rows_per_sec:.0f} rows/s)")
+        for line_no, message in report.errors[:10]:
+            print(f"  line {line_no}: {message}")
+    else:
+        inv.add_product(Product(1, "Tablet", "Digital", to_cents(2000), 5))
+        inv.add_product(Product(2, "Computer", "Digital", to_cents(4000), 3))
+        inv.add_product(Product(3, "Mouse", "Accessory", to_cents(550), 10))
+
+    user_name = "Default User"
+    if log is not None:
+        if isinstance(inv, MappedInventory):
+            # logging needs listeners on every product: load the mapped catalog
+            mapped, inv = inv, Inventory(inv.strip_accents)
+            inv.add_products(mapped.list_products())
+        inv.attach_log(log, write_products=log.durable_lsn == 0)
+
+    if db_path:
+        log = inv
+        orders[user_name] = inv.list_orders(user_name)
+
+    user = User(user_name, ReservationLedger(), log)
+    user.orders = orders.get(user.name, [])
+    checkpointer = None
+    if log_path:
+        checkpointer = Checkpointer(log, inv, [user]).start()
 
     while True:
         print("""
@@ -231,6 +2811,7 @@ def main():
         5) Update/remove cart items
         6) Checkout
         7) Show orders
+        8) Browse by category
         0) Exit
         ===================================
 """)
@@ -287,36 +2868,56 @@ def main():
 """)
             opt = input("Select: ")
 
-            if opt == "1":
-                disc = NoDiscount()
-            elif opt == "2":
-                p = float(input("Percent: "))
-                disc = PercentageDiscount(p)
-            elif opt == "3":
-                a = float(input("Amount: "))
-                disc = FixedAmountDiscount(a)
-            elif opt == "4":
-                t = float(input("Threshold: "))
-                p = float(input("Percent: "))
-                disc = ThresholdPercentageDiscount(t, p)
-            else:
-                print("Invalid option\n")
+            try:
+                if opt == "1":
+                    disc = NoDiscount()
+                elif opt == "2":
+                    p = float(input("Percent: "))
+                    disc = PercentageDiscount(p)
+                elif opt == "3":
+                    a = to_cents(input("Amount: "))
+                    disc = FixedAmountDiscount(a)
+                elif opt == "4":
+                    t = to_cents(input("Threshold: "))
+                    p = float(input("Percent: "))
+                    disc = ThresholdPercentageDiscount(t, p)
+                else:
+                    print("Invalid option\n")
+                    continue
+            except ValueError as e:
+                print(str(e))
                 continue
 
+            placed = len(user.orders)
             try:
                 order = user.checkout(disc)
                 print("\nCheckout complete!")
                 print(f"Order ID: {order.id}")
-                print(f"Before: {order.total_before}")
-                print(f"Discount: {order.discount_amount}")
-                print(f"After: {order.total_after}\n")
+                print(f"Before: {format_money(order.total_before)}")
+                print(f"Discount: {format_money(order.discount_amount)}")
+                print(f"After: {format_money(order.total_after)}\n")
             except ValueError as e:
                 print(str(e))
+            except (OSError, sqlite3.Error) as e:
+                if len(user.orders) > placed:
+                    # the order was placed, only saving it failed
+                    print(f"Order {user.orders[-1].id} was placed but may not be saved: {e}")
+                else:
+                    print(f"Checkout failed: {e}")
 
         elif choice == "7":
             print_orders(user.orders)
 
+        elif choice == "8":
+            print("Categories: " + ", ".join(inv.list_categories()))
+            category = input("Category: ")
+            print_products(inv.list_by_category(category))
+
         elif choice == "0":
+            if checkpointer is not None:
+                checkpointer.stop()
+            if log is not None:
+                log.close()
             print("Goodbye!")
             break
 
@@ -325,4 +2926,5 @@ def main():
 
 
 # Run
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,881 @@
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+# the shop module has a dash in its file name, so load it by path
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_spec = importlib.util.spec_from_file_location("shop", os.path.join(_HERE, "Edrisi-Project1.py"))
+shop = importlib.util.module_from_spec(_spec)
+sys.modules["shop"] = shop
+_spec.loader.exec_module(shop)
+# a single process writing throwaway stores
+shop.Order.id_generator = shop.SnowflakeIdGenerator(node_id=0)
+
+
+WORDS = [
+    "tablet", "computer", "mouse", "keyboard", "monitor", "laptop", "phone",
+    "charger", "cable", "speaker", "headset", "camera", "printer", "router",
+    "gaming", "wireless", "pro", "mini", "ultra", "classic", "smart", "desk",
+]
+CATEGORIES = ["Digital", "Accessory", "Audio", "Office", "Network", "Gaming"]
+
+
+def make_products(n, seed=1):
+    rnd = random.Random(seed)
+    products = []
+    for i in range(1, n + 1):
+        name = " ".join(rnd.sample(WORDS, 2)).title() + f" {i}"
+        category = rnd.choice(CATEGORIES)
+        price = rnd.randint(1_000, 500_000)  # cents
+        stock = rnd.randint(0, 100)
+        products.append(shop.Product(i, name, category, price, stock))
+    return products
+
+
+def make_inventory(n, seed=1):
+    inv = shop.Inventory()
+    for p in make_products(n, seed):
+        inv.add_product(p)
+    return inv
+
+
+def timed(fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def allocated(fn):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def report(label, seconds, baseline=None):
+    line = f"  {label:<40} {seconds * 1000:10.3f} ms"
+    if baseline:
+        line += f"   x{baseline / seconds:.1f}"
+    print(line)
+
+
+# Benchmarks
+
+def linear_search(inv, keyword):
+    keyword = keyword.lower()
+    return [
+        p for p in inv.products.values()
+        if keyword in p.name.lower() or keyword in p.category.lower()
+    ]
+
+
+def bench_search(n=200_000):
+    print(f"search over {n} products")
+    inv = make_inventory(n)
+    for keyword in ["keyboard", "audio", "gaming mouse", "199999", "tab", "ablet", "9999"]:
+        expected = linear_search(inv, keyword)
+        assert [p.id for p in inv.search(keyword)] == [p.id for p in expected]
+        base = timed(lambda: linear_search(inv, keyword), 3)
+        report(f"linear scan '{keyword}'", base)
+        report(f"indexed '{keyword}' ({len(expected)} hits)", timed(lambda: inv.search(keyword), 3), base)
+
+
+def bench_category(n=200_000):
+    print(f"category listing over {n} products")
+    inv = make_inventory(n)
+    for category in ["Digital", "Network"]:
+        expected = [p for p in inv.list_products() if p.category == category]
+        assert inv.list_by_category(category) == expected
+        base = timed(lambda: [p for p in inv.list_products() if p.category == category], 3)
+        report(f"filtered scan '{category}'", base)
+        report(f"list_by_category '{category}'", timed(lambda: inv.list_by_category(category), 3), base)
+    distinct = len({id(p.category) for p in inv.list_products()})
+    print(f"  distinct category string objects: {distinct}")
+
+
+def bench_price(n=200_000):
+    print(f"price queries over {n} products")
+    inv = make_inventory(n)
+
+    def sorted_range():
+        return sorted((p for p in inv.list_products() if 50_000 <= p.price <= 200_000), key=lambda p: p.price)
+
+    def sorted_top():
+        return sorted((p for p in inv.list_products() if p.category == "Digital"), key=lambda p: p.price)[:10]
+
+    base = timed(sorted_range, 3)
+    report("sort scan, 500..2000 page 1", base)
+    report("list_by_price, 500..2000 page 1", timed(lambda: inv.list_by_price(50_000, 200_000, limit=50), 3), base)
+    base = timed(sorted_top, 3)
+    report("sort scan, 10 cheapest Digital", base)
+    report("cheapest(10, 'Digital')", timed(lambda: inv.cheapest(10, "Digital"), 3), base)
+    product = inv.find_by_id(n // 2)
+    report("price update (reindex)", timed(lambda: setattr(product, "price", product.price + 1), 1000))
+
+
+def bench_columnar(n=200_000):
+    print(f"memory of {n} products (inventory including indexes)")
+    products = make_products(n)
+
+    def build(cls):
+        inv = cls()
+        for p in products:
+            inv.add_product(shop.Product(p.id, p.name, p.category, p.price, p.stock))
+        return inv
+
+    _, object_bytes = allocated(lambda: build(shop.Inventory))
+    inv, columnar_bytes = allocated(lambda: build(shop.ColumnarInventory))
+    print(f"  Inventory          {object_bytes / n:8.0f} bytes/product")
+    print(f"  ColumnarInventory  {columnar_bytes / n:8.0f} bytes/product")
+
+    # the product records alone, without the search/category/price indexes
+    _, record_bytes = allocated(lambda: {
+        p.id: shop.Product(p.id, p.name, p.category, p.price, p.stock) for p in products
+    })
+    columns = [inv._rows, inv._id_col, inv._price_col, inv._stock_col, inv._name_col, inv._category_col]
+    column_bytes = sum(sys.getsizeof(c) for c in columns)
+    print(f"  Product objects    {record_bytes / n:8.0f} bytes/product (records only)")
+    print(f"  columns            {column_bytes / n:8.0f} bytes/product (records only)")
+
+    cart = shop.ShoppingCart()
+    cart.add_item(inv.find_by_id(1), 1)
+    assert cart.calculate_total() == inv.find_by_id(1).price
+
+
+# dict-based copies of the original classes, for comparison
+class DictProduct:
+    def __init__(self, product_id, name, category, price, stock):
+        self.id = product_id
+        self.name = name
+        self.category = category
+        self.price = price
+        self.stock = stock
+
+
+class DictCartItem:
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+
+
+class DictOrder:
+    def __init__(self, items, total_before, discount_amount, total_after):
+        self.id = str(uuid.uuid4())[:8]
+        self.items = items
+        self.total_before = total_before
+        self.discount_amount = discount_amount
+        self.total_after = total_after
+
+
+def bench_slots(n=100_000):
+    print(f"per-object memory, {n} objects each")
+    product = shop.Product(1, "Tablet", "Digital", 2000, 5)
+    pairs = [
+        ("Product", lambda: DictProduct(1, "Tablet", "Digital", 2000, 5),
+         lambda: shop.Product(1, "Tablet", "Digital", 2000, 5)),
+        ("CartItem", lambda: DictCartItem(product, 1), lambda: shop.CartItem(product, 1)),
+        ("Order", lambda: DictOrder([], 1, 0, 1), lambda: shop.Order([], 1, 0, 1)),
+    ]
+    for label, before, after in pairs:
+        _, dict_bytes = allocated(lambda: [before() for _ in range(n)])
+        _, slot_bytes = allocated(lambda: [after() for _ in range(n)])
+        print(f"  {label:<10} {dict_bytes / n:6.0f} -> {slot_bytes / n:4.0f} bytes/object")
+
+
+def write_catalog_csv(path, n):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("id,name,category,price,stock\n")
+        for p in make_products(n):
+            f.write(f"{p.id},{p.name},{p.category},{shop.format_money(p.price)},{p.stock}\n")
+
+
+def bench_load(n=200_000):
+    print(f"loading a {n}-row CSV catalog")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.csv")
+        write_catalog_csv(path, n)
+
+        def one_at_a_time():
+            inv = shop.Inventory()
+            with open(path, newline="", encoding="utf-8") as f:
+                for row in shop.csv.DictReader(f):
+                    inv.add_product(shop.product_from_row(row))
+            return inv
+
+        base = timed(one_at_a_time)
+        report("add_product per row", base)
+        inv = shop.Inventory()
+        result = shop.load_catalog(inv, path)
+        report(f"load_catalog ({result.rows_per_sec:.0f} rows/s)", result.seconds, base)
+        assert result.loaded == n and inv.cheapest(1)[0].price == one_at_a_time().cheapest(1)[0].price
+
+
+def bench_mapped(n=200_000):
+    print(f"cold start of a {n}-product catalog")
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "catalog.csv")
+        bin_path = os.path.join(tmp, "catalog.bin")
+        write_catalog_csv(csv_path, n)
+        shop.write_catalog(make_products(n), bin_path)
+
+        base = timed(lambda: shop.load_catalog(shop.Inventory(), csv_path))
+        report("load_catalog from CSV", base)
+        report("MappedInventory open", timed(lambda: shop.MappedInventory(bin_path).close()), base)
+
+        inv = make_inventory(n)
+        with shop.MappedInventory(bin_path) as mapped:
+            report("find_by_id (mapped, first access)", timed(lambda: mapped.find_by_id(n // 3)))
+            for keyword in ["9999", "gaming mouse"]:
+                assert [p.id for p in mapped.search(keyword)] == [p.id for p in inv.search(keyword)]
+                base = timed(lambda: inv.search(keyword), 3)
+                report(f"Inventory.search '{keyword}'", base)
+                report(f"MappedInventory.search '{keyword}'", timed(lambda: mapped.search(keyword), 3), base)
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def bench_stock(threads=16, products=32, stock=2_000):
+    print(f"stock stress: {threads} threads buying from {products} products")
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        for label, locks in [("one global lock", shop.StripedLocks(1)),
+                             ("striped locks (64)", shop.StripedLocks(64))]:
+            shop.STOCK_LOCKS = locks
+            inv = shop.Inventory()
+            for i in range(products):
+                inv.add_product(shop.Product(i, f"P{i}", "Stress", 1, stock))
+            sold = [0] * threads
+
+            def buyer(t):
+                rnd = random.Random(t)
+                for _ in range(products * stock // threads * 2):
+                    amount = rnd.randint(1, 3)
+                    try:
+                        inv.reduce_stock(rnd.randrange(products), amount)
+                        sold[t] += amount
+                    except ValueError:
+                        pass
+
+            start = time.perf_counter()
+            run_threads(threads, buyer)
+            elapsed = time.perf_counter() - start
+            left = [p.stock for p in inv.list_products()]
+            assert min(left) >= 0, "oversold"
+            assert sum(sold) == products * stock - sum(left), "lost update"
+            report(f"{label} ({sum(sold)} units sold)", elapsed)
+    finally:
+        sys.setswitchinterval(old_interval)
+        shop.STOCK_LOCKS = shop.StripedLocks()
+
+
+def naive_checkout(user, discount):
+    # the old per-item loop: a failure part way leaves earlier lines decremented
+    total = user.cart.calculate_total()
+    discount_amount = discount.apply(total)
+    for item in user.cart.items.values():
+        item.product.reduce_stock(item.quantity)
+    order = shop.Order(list(user.cart.items.values()), total, discount_amount, total - discount_amount)
+    user.orders.append(order)
+    user.cart.clear()
+    return order
+
+
+def bench_checkout(threads=16, checkouts=4_000, products=20, stock=400):
+    print(f"checkout under contention: {threads} threads, {products} products")
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        for label, checkout in [("per-item loop (old)", naive_checkout),
+                                ("atomic checkout", shop.User.checkout)]:
+            inv = shop.Inventory()
+            for i in range(products):
+                inv.add_product(shop.Product(i, f"P{i}", "Stress", 1, stock))
+            bought = [0] * threads
+
+            # fill every cart up front, so stock runs out during the checkouts
+            users = []
+            for t in range(threads):
+                rnd = random.Random(t)
+                users.append([])
+                for c in range(checkouts // threads):
+                    user = shop.User(f"user{t}-{c}")
+                    for _ in range(3):
+                        user.cart.add_item(inv.find_by_id(rnd.randrange(products)), rnd.randint(1, 3))
+                    users[t].append(user)
+
+            def shopper(t):
+                for user in users[t]:
+                    units = sum(item.quantity for item in user.cart.items.values())
+                    try:
+                        checkout(user, shop.NoDiscount())
+                        bought[t] += units
+                    except ValueError:
+                        pass
+
+            start = time.perf_counter()
+            run_threads(threads, shopper)
+            elapsed = time.perf_counter() - start
+            removed = products * stock - sum(p.stock for p in inv.list_products())
+            leaked = removed - sum(bought)
+            report(f"{label}: {checkouts / elapsed:.0f} checkouts/s, {leaked} units lost", elapsed)
+            if checkout is shop.User.checkout:
+                assert leaked == 0, "partial checkout"
+    finally:
+        sys.setswitchinterval(old_interval)
+
+
+def bench_reservations(carts=100_000):
+    print(f"reservation expiry with {carts} live carts")
+    now = [0.0]
+    ledger = shop.ReservationLedger(ttl=1_200, clock=lambda: now[0])
+    inv = make_inventory(1_000)
+    for p in inv.list_products():
+        p.stock = carts
+    users = []
+    for i in range(carts):
+        now[0] = i * 0.01  # one new cart every 10 ms
+        user = shop.User(f"user{i}", ledger)
+        user.cart.add_item(inv.find_by_id(i % 1_000 + 1), 1)
+        users.append(user)
+
+    def scan_all():
+        return [(cart, pid) for cart, holds in ledger._holds.items()
+                for pid, (_, expires_at) in holds.items() if expires_at <= now[0]]
+
+    for step in [1, 300]:
+        now[0] += step
+        due = len(scan_all())
+        base = timed(scan_all)
+        report(f"scan every cart ({due} due)", base)
+        report(f"heap expire() ({due} due)", timed(ledger.expire), base)
+        assert len(ledger._holds) == carts - due
+
+    report("checkout converting a hold", timed(lambda: users[-1].checkout(shop.NoDiscount())))
+
+
+def bench_optimistic(sales=40_000):
+    print(f"{sales} single-unit sales of one hot product")
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        for threads in [1, 8, 32]:
+            results = {}
+            for label, cls in [("locked", shop.Product), ("optimistic", shop.OptimisticProduct)]:
+                product = cls(1, "Hot", "Sale", 1, sales)
+
+                def buyer(t):
+                    for _ in range(sales // threads):
+                        product.reduce_stock(1)
+
+                start = time.perf_counter()
+                run_threads(threads, buyer)
+                results[label] = time.perf_counter() - start
+                assert product.stock == sales - sales // threads * threads
+            report(f"{threads:>2} threads, locked", results["locked"])
+            report(f"{threads:>2} threads, optimistic", results["optimistic"], results["locked"])
+    finally:
+        sys.setswitchinterval(old_interval)
+
+
+def bench_batch(users=20_000, products=50):
+    print(f"checking out {users} users over {products} products")
+
+    def setup():
+        inv = shop.Inventory()
+        for i in range(products):
+            inv.add_product(shop.Product(i, f"P{i}", "Drop", 100, users // 20))
+        rnd = random.Random(7)
+        batch = []
+        for u in range(users):
+            user = shop.User(f"user{u}")
+            for _ in range(3):
+                user.cart.add_item(inv.find_by_id(rnd.randrange(products)), rnd.randint(1, 2))
+            batch.append(user)
+        return inv, batch
+
+    def per_user(batch):
+        placed = 0
+        for user in batch:
+            try:
+                user.checkout(shop.NoDiscount())
+                placed += 1
+            except ValueError:
+                pass
+        return placed
+
+    inv, batch = setup()
+    start = time.perf_counter()
+    placed = per_user(batch)
+    base = time.perf_counter() - start
+    report(f"per-user loop ({users / base:.0f}/s, {placed} orders)", base)
+
+    inv2, batch = setup()
+    start = time.perf_counter()
+    result = shop.batch_checkout(batch, shop.NoDiscount())
+    elapsed = time.perf_counter() - start
+    report(f"batch_checkout ({users / elapsed:.0f}/s, {len(result.orders)} orders)", elapsed, base)
+    assert [p.stock for p in inv.list_products()] == [p.stock for p in inv2.list_products()]
+
+
+def bench_cart_total(lines=5_000):
+    print(f"calculate_total on a {lines}-line cart")
+    cart = shop.ShoppingCart()
+    for p in make_products(lines):
+        p.stock = 10
+        cart.add_item(p, 2)
+    base = timed(lambda: sum(item.line_total for item in cart.items.values()), 100)
+    report("re-sum every line", base)
+    report("running total", timed(cart.calculate_total, 100), base)
+    item = cart.items[lines // 2]
+    report("update_quantity (keeps total current)", timed(lambda: cart.update_quantity(item.product.id, 3), 1000))
+
+
+def bench_money(carts=100_000):
+    print(f"pricing {carts} carts of 3 lines with 12.5% off")
+    rnd = random.Random(3)
+    lines = [[(rnd.randint(100, 500_000), rnd.randint(1, 3)) for _ in range(3)] for _ in range(carts)]
+    float_lines = [[(cents / 100, qty) for cents, qty in cart] for cart in lines]
+    decimal_lines = [[(shop.Decimal(cents) / 100, qty) for cents, qty in cart] for cart in lines]
+    cent = shop.Decimal("0.01")
+
+    def with_floats():
+        # the old float path plus the Decimal clean-up it needed downstream
+        out = []
+        for cart in float_lines:
+            total = sum(price * qty for price, qty in cart)
+            discount = total * (12.5 / 100)
+            out.append(shop.Decimal(total - discount).quantize(cent, rounding=shop.ROUND_HALF_UP))
+        return out
+
+    def with_decimal():
+        rate = shop.Decimal("0.125")
+        out = []
+        for cart in decimal_lines:
+            total = sum(price * qty for price, qty in cart)
+            out.append(total - (total * rate).quantize(cent, rounding=shop.ROUND_HALF_UP))
+        return out
+
+    strategy = shop.PercentageDiscount(12.5)
+
+    def with_cents():
+        out = []
+        for cart in lines:
+            total = sum(price * qty for price, qty in cart)
+            out.append(total - strategy.apply(total))
+        return out
+
+    base = timed(with_floats)
+    report("float + Decimal rounding", base)
+    report("Decimal", timed(with_decimal), base)
+    report("integer cents", timed(with_cents), base)
+    assert [int(d * 100) for d in with_decimal()] == with_cents()
+
+
+def bench_discounts(n=1_000_000):
+    backend = "NumPy" if shop.np is not None else "pure Python fallback"
+    print(f"re-pricing {n} cart totals ({backend})")
+    rnd = random.Random(5)
+    totals = [rnd.randint(0, 2_000_000) for _ in range(n)]
+    if shop.np is not None:
+        totals = shop.np.asarray(totals, dtype=shop.np.int64)
+    strategies = [
+        shop.NoDiscount(),
+        shop.PercentageDiscount(12.5),
+        shop.FixedAmountDiscount(5_000),
+        shop.ThresholdPercentageDiscount(100_000, 10),
+    ]
+    for strategy in strategies:
+        name = type(strategy).__name__
+        base = timed(lambda: [strategy.apply(total) for total in totals])
+        report(f"{name}.apply per total", base)
+        report(f"{name}.apply_many", timed(lambda: strategy.apply_many(totals)), base)
+        assert list(strategy.apply_many(totals[:1000])) == [strategy.apply(t) for t in totals[:1000]]
+
+
+# the ad-hoc wrappers a pipeline replaces
+class NaiveOrdered(shop.DiscountStrategy):
+    def __init__(self, strategies):
+        self.strategies = strategies
+
+    def apply(self, total):
+        discount = 0
+        for strategy in self.strategies:
+            step = strategy.apply(total - discount)
+            discount += step
+        return discount
+
+
+class NaiveBest(shop.DiscountStrategy):
+    def __init__(self, strategies):
+        self.strategies = strategies
+
+    def apply(self, total):
+        return max(strategy.apply(total) for strategy in self.strategies)
+
+
+class NaiveCapped(shop.DiscountStrategy):
+    def __init__(self, strategy, cap):
+        self.strategy = strategy
+        self.cap = cap
+
+    def apply(self, total):
+        return min(self.strategy.apply(total), self.cap, total)
+
+
+def bench_pipeline(n=300_000):
+    print(f"stacked promotions over {n} totals")
+    rnd = random.Random(9)
+    totals = [rnd.randint(0, 2_000_000) for _ in range(n)]
+    members = lambda: [
+        shop.PercentageDiscount(10),
+        shop.FixedAmountDiscount(2_500),
+        shop.ThresholdPercentageDiscount(500_000, 5),
+    ]
+    naive = NaiveCapped(NaiveOrdered([NaiveBest(members()[:2]), members()[2]]), 40_000)
+    compiled = shop.DiscountPipeline(
+        [shop.DiscountPipeline(members()[:2], "best"), members()[2]], "ordered", cap=40_000
+    )
+    assert [naive.apply(t) for t in totals[:10_000]] == [compiled.apply(t) for t in totals[:10_000]]
+    base = timed(lambda: [naive.apply(t) for t in totals])
+    report("nested wrappers", base)
+    report("compiled pipeline", timed(lambda: [compiled.apply(t) for t in totals]), base)
+    report("compiled pipeline, apply_many", timed(lambda: compiled.apply_many(totals)), base)
+
+
+def bench_rules(product_rules=5_000, lines=50):
+    print(f"{product_rules} product rules + {len(CATEGORIES) * 2} category rules, {lines}-line cart")
+    products = make_products(product_rules * 2)
+    rnd = random.Random(11)
+    rules = []
+    for p in rnd.sample(products, product_rules):
+        if rnd.random() < 0.5:
+            rules.append(shop.PercentageOffRule(rnd.randint(5, 30), product_id=p.id))
+        else:
+            rules.append(shop.BuyXGetYFreeRule(2, 1, product_id=p.id))
+    for category in CATEGORIES:
+        rules.append(shop.PercentageOffRule(5, category=category))
+        rules.append(shop.BuyXGetYFreeRule(4, 1, category=category))
+    engine = shop.RuleEngine(rules)
+
+    cart = shop.ShoppingCart()
+    for p in rnd.sample(products, lines):
+        p.stock = 10
+        cart.add_item(p, rnd.randint(1, 6))
+
+    def every_rule():
+        total = 0
+        for item in cart.items.values():
+            amounts = [rule.discount(item) for rule in rules if rule.applies_to(item.product)]
+            if amounts:
+                total += min(max(amounts), item.line_total)
+        return total
+
+    assert every_rule() == engine.evaluate(cart)[0]
+    base = timed(every_rule, 5)
+    report("every rule against every line", base)
+    report("RuleEngine.evaluate", timed(lambda: engine.evaluate(cart), 5), base)
+
+
+def bench_quotes(carts=1_000, requests=50_000):
+    print(f"{requests} quote requests over {carts} carts, 1 in 20 after a cart change")
+    products = make_products(2_000)
+    for p in products:
+        p.stock = 1_000
+    engine = shop.RuleEngine(
+        [shop.PercentageOffRule(15, category=c) for c in CATEGORIES]
+        + [shop.BuyXGetYFreeRule(2, 1, product_id=p.id) for p in products[::10]]
+    )
+    strategy = shop.DiscountPipeline(
+        [shop.PercentageDiscount(5), shop.ThresholdPercentageDiscount(100_000, 5)], cap=50_000
+    )
+    rnd = random.Random(13)
+    pool = []
+    for _ in range(carts):
+        cart = shop.ShoppingCart()
+        for p in rnd.sample(products, 20):
+            cart.add_item(p, rnd.randint(1, 4))
+        pool.append(cart)
+    plan = [(rnd.randrange(carts), rnd.random() < 0.05, rnd.randint(1, 4)) for _ in range(requests)]
+
+    def run(quote):
+        for index, mutate, qty in plan:
+            cart = pool[index]
+            if mutate:
+                cart.update_quantity(next(iter(cart.items)), qty)
+            quote(cart)
+
+    base = timed(lambda: run(lambda cart: shop.price_cart(cart, strategy, engine)))
+    report("price_cart on every request", base)
+    cache = shop.QuoteCache(maxsize=carts * 2)
+    elapsed = timed(lambda: run(lambda cart: cache.quote(cart, strategy, engine)))
+    report(f"QuoteCache (hit rate {cache.hit_rate:.0%})", elapsed, base)
+
+
+def bench_order_ids(n=200_000):
+    print(f"generating {n} order ids")
+    legacy = shop.UuidIdGenerator()
+    snowflake = shop.SnowflakeIdGenerator(node_id=1)
+    legacy_ids = [legacy.next_id() for _ in range(n)]
+    snowflake_ids = [snowflake.next_id() for _ in range(n)]
+    print(f"  uuid4()[:8] collisions:  {n - len(set(legacy_ids))}")
+    print(f"  snowflake collisions:    {n - len(set(snowflake_ids))}")
+    assert snowflake_ids == sorted(set(snowflake_ids))
+
+    base = timed(lambda: [legacy.next_id() for _ in range(n)])
+    report("uuid4()[:8]", base)
+    report("SnowflakeIdGenerator", timed(lambda: [snowflake.next_id() for _ in range(n)]), base)
+
+
+def bench_order_history(orders=50_000):
+    print(f"history of {orders} orders with 3 lines each")
+    products = make_products(1_000)
+    rnd = random.Random(17)
+    carts = [[shop.CartItem(p, rnd.randint(1, 3)) for p in rnd.sample(products, 3)] for _ in range(orders)]
+
+    # old style: orders keep the live CartItems (and through them the Products)
+    live, live_bytes = allocated(lambda: [
+        DictOrder([shop.CartItem(i.product, i.quantity) for i in cart], 1, 0, 1) for cart in carts
+    ])
+    snapshots, snapshot_bytes = allocated(lambda: [shop.Order(cart, 1, 0, 1) for cart in carts])
+    print(f"  live CartItems   {live_bytes / orders:6.0f} bytes/order (plus the Products kept alive)")
+    print(f"  OrderLine tuples {snapshot_bytes / orders:6.0f} bytes/order")
+
+    def walk_live():
+        return shop.json.dumps([
+            {"id": o.id, "items": [[i.product.id, i.product.name, i.product.price, i.quantity] for i in o.items],
+             "total_before": o.total_before, "discount_amount": o.discount_amount, "total_after": o.total_after}
+            for o in live
+        ])
+
+    base = timed(walk_live)
+    report("serialize by walking live objects", base)
+    report("serialize Order.to_dict()", timed(lambda: shop.json.dumps([o.to_dict() for o in snapshots])), base)
+
+
+# the obvious durable log: every append writes and fsyncs under one lock
+class SyncLog:
+    def __init__(self, path):
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+        self.lsn = 0
+
+    def append(self, record, wait=False):
+        line = (shop.json.dumps(record, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.lsn += 1
+            return self.lsn
+
+    def wait(self, lsn):
+        pass
+
+    def close(self):
+        self._file.close()
+
+
+def bench_wal(threads=16, checkouts=4_000, products=20):
+    print(f"{checkouts} durable checkouts from {threads} threads")
+    per_thread = checkouts // threads
+
+    def run(make_log, path):
+        inv = shop.Inventory()
+        for i in range(products):
+            inv.add_product(shop.Product(i, f"P{i}", "Drop", 100, checkouts))
+        log = make_log(path) if make_log else None
+        if log is not None:
+            inv.attach_log(log, write_products=True)
+        users = [shop.User(f"user{i}", None, log) for i in range(threads)]
+
+        def worker(i):
+            user = users[i]
+            for k in range(per_thread):
+                user.cart.add_item(inv.find_by_id((i + k) % products), 1)
+                user.checkout(shop.NoDiscount())
+
+        start = time.perf_counter()
+        run_threads(threads, worker)
+        elapsed = time.perf_counter() - start
+        if log is not None:
+            log.close()
+        return elapsed, inv, users, log
+
+    with tempfile.TemporaryDirectory() as tmp:
+        memory, _, _, _ = run(None, None)
+        report(f"in memory ({checkouts / memory:.0f}/s)", memory)
+        base, _, _, _ = run(SyncLog, os.path.join(tmp, "sync.log"))
+        report(f"fsync per record ({checkouts / base:.0f}/s)", base)
+        path = os.path.join(tmp, "group.log")
+        elapsed, inv, users, log = run(shop.OrderLog, path)
+        report(f"group commit ({checkouts / elapsed:.0f}/s, {log.flushes} fsyncs)", elapsed, base)
+
+        start = time.perf_counter()
+        inv2, orders = shop.replay_log(path)
+        elapsed = time.perf_counter() - start
+        report(f"replay ({log.durable_lsn} records)", elapsed)
+        assert [p.stock for p in inv2.list_products()] == [p.stock for p in inv.list_products()]
+        assert sum(map(len, orders.values())) == sum(len(u.orders) for u in users)
+
+
+def bench_recovery(histories=(10_000, 40_000, 160_000), tail=1_000, products=200):
+    print(f"recovery time vs. history length ({tail} records after the snapshot)")
+    with tempfile.TemporaryDirectory() as tmp:
+        for history in histories:
+            path = os.path.join(tmp, f"shop{history}.log")
+            inv = shop.Inventory()
+            for i in range(products):
+                inv.add_product(shop.Product(i, f"P{i}", "Drop", 100, history * 2))
+            log = shop.OrderLog(path, fsync=False)
+            inv.attach_log(log, write_products=True)
+            user = shop.User("user", None, log)
+
+            def checkouts(n):
+                for k in range(n):
+                    user.cart.add_item(inv.find_by_id(k % products), 1)
+                    user.checkout(shop.NoDiscount())
+
+            checkouts(history)
+            log.sync()
+            base = timed(lambda: shop.replay_log(path))
+            report(f"{history} checkouts, full replay", base)
+
+            # snapshot while another thread keeps checking out
+            other = shop.User("other", None, log)
+            done = threading.Event()
+
+            def shopper():
+                while not done.is_set():
+                    other.cart.add_item(inv.find_by_id(0), 1)
+                    other.checkout(shop.NoDiscount())
+
+            thread = threading.Thread(target=shopper)
+            thread.start()
+            start = time.perf_counter()
+            shop.take_snapshot(log, inv, [user, other])
+            snapshot = time.perf_counter() - start
+            done.set()
+            thread.join()
+            report(f"  take_snapshot ({len(other.orders)} checkouts meanwhile)", snapshot)
+
+            checkouts(tail // 2)
+            log.close()
+            elapsed = timed(lambda: shop.replay_log(path))
+            report("  snapshot + tail", elapsed, base)
+            inv2, orders = shop.replay_log(path)
+            assert [p.stock for p in inv2.list_products()] == [p.stock for p in inv.list_products()]
+            assert len(orders["user"]) == len(user.orders) and len(orders["other"]) == len(other.orders)
+
+
+def bench_sqlite(n=100_000, threads=16, checkouts=4_000):
+    print(f"SQLite storage: {n} products, {checkouts} checkouts from {threads} threads")
+    with tempfile.TemporaryDirectory() as tmp:
+        # one INSERT and one commit per product, on a sample of the catalog
+        sample = 2_000
+        conn = shop.sqlite3.connect(os.path.join(tmp, "naive.db"))
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, category TEXT, price INTEGER, stock INTEGER)")
+        start = time.perf_counter()
+        for p in make_products(sample):
+            conn.execute("INSERT INTO products VALUES (?, ?, ?, ?, ?)", (p.id, p.name, p.category, p.price, p.stock))
+            conn.commit()
+        base = (time.perf_counter() - start) * n / sample
+        conn.close()
+        report(f"insert + commit per row ({n / base:.0f}/s, est.)", base)
+
+        db = shop.SQLiteInventory(os.path.join(tmp, "shop.db"))
+        products = make_products(n)
+        elapsed = timed(lambda: db.add_products(products))
+        report(f"add_products ({n / elapsed:.0f}/s)", elapsed, base)
+        del products
+
+        rnd = random.Random(3)
+        ids = [rnd.randrange(n) + 1 for _ in range(20_000)]
+        elapsed = timed(lambda: [db.find_by_id(i) for i in ids])
+        report(f"find_by_id x{len(ids)} ({len(ids) / elapsed:.0f}/s)", elapsed)
+        report("search('gaming mouse')", timed(lambda: db.search("gaming mouse"), 5))
+        report("cheapest(20, 'Audio')", timed(lambda: db.cheapest(20, "Audio"), 50))
+        report("list_by_price(1k-2k, limit=50)", timed(lambda: db.list_by_price(100_000, 200_000, limit=50), 50))
+
+        # durable checkouts: a commit per order vs. group commit
+        def run(log_for):
+            hot = [db.find_by_id(i + 1) for i in range(20)]
+            for p in hot:
+                p.stock = checkouts
+            db.sync()
+            users = [shop.User(f"user{i}", None, log_for(i)) for i in range(threads)]
+
+            def worker(i):
+                for k in range(checkouts // threads):
+                    users[i].cart.add_item(hot[(i + k) % len(hot)], 1)
+                    users[i].checkout(shop.NoDiscount())
+
+            start = time.perf_counter()
+            run_threads(threads, worker)
+            return time.perf_counter() - start
+
+        class CommitEach:
+            def append(self, record, wait=False):
+                db.append(record)
+                db.sync()
+
+        base = run(lambda i: CommitEach())
+        report(f"commit per checkout ({checkouts / base:.0f}/s)", base)
+        elapsed = run(lambda i: db)
+        report(f"group commit ({checkouts / elapsed:.0f}/s)", elapsed, base)
+        assert len(db.list_orders(since=0)) == 2 * (checkouts // threads) * threads
+        db.close()
+
+
+BENCHMARKS = {
+    "search": bench_search,
+    "category": bench_category,
+    "price": bench_price,
+    "columnar": bench_columnar,
+    "slots": bench_slots,
+    "load": bench_load,
+    "mapped": bench_mapped,
+    "stock": bench_stock,
+    "checkout": bench_checkout,
+    "reservations": bench_reservations,
+    "optimistic": bench_optimistic,
+    "batch": bench_batch,
+    "cart_total": bench_cart_total,
+    "money": bench_money,
+    "discounts": bench_discounts,
+    "pipeline": bench_pipeline,
+    "rules": bench_rules,
+    "quotes": bench_quotes,
+    "order_ids": bench_order_ids,
+    "order_history": bench_order_history,
+    "wal": bench_wal,
+    "recovery": bench_recovery,
+    "sqlite": bench_sqlite,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])